@@ -1,11 +1,14 @@
 """
 从环境变量读取配置，适用于 Docker 与 K8s。
 """
-from typing import Optional
+from typing import List, Literal, Optional
 
-from pydantic import Field
+from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+# pano.png 的宽度（generate_video_tool.pano_video_generation.PANO_WIDTH）
+PANO_WIDTH = 4096
+
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(
@@ -27,10 +30,23 @@ class Settings(BaseSettings):
     # 推理
     inference_timeout_seconds: int = Field(default=600, description="单次推理最大耗时（秒）")
 
+    # 全景视频渲染流水线（video.mp4）：渲染线程数与在途帧块数，不填则按 CPU 核数
+    video_workers: Optional[int] = Field(default=None, description="video.mp4 渲染线程数，默认 CPU 核数")
+    video_queue_depth: Optional[int] = Field(default=None, description="video.mp4 渲染与编码之间的在途帧块上限，默认 2 倍渲染线程数")
+    # 全景拼接与视频渲染的投影后端：opencv（CPU remap）或 torch（grid_sample，可在 GPU 上运行）
+    stitch_backend: str = Field(default="opencv", description="pano.png / video.mp4 投影后端：opencv 或 torch")
+    stitch_device: Optional[str] = Field(default=None, description="torch 后端使用的设备，如 cuda:0，默认与模型同一设备")
+    pano_ladder: List[int] = Field(default_factory=lambda: [512, 2048], description="除 pano.png（4096 宽）外额外输出的全景图宽度，需整除 4096，如 [512, 2048]")
+    pano_format: Literal["equirect", "cubemap", "both"] = Field(default="equirect", description="全景输出格式：equirect（pano.png）、cubemap（六面体贴图 cube_<面>.png）或 both")
+    cube_face_size: int = Field(default=1024, description="六面体贴图边长（像素）")
+    stitch_memory_mb: Optional[int] = Field(default=64, description="opencv 后端分条拼接的缓冲上限（MB），pano.png 逐条流式写出；置空则整图拼接")
+
     # 路径（Docker 下挂载卷并设置）
     project_root: str = Field(default="/app", description="项目根目录，含 demo.py、configs、weights、outputs")
     weights_dir: str = Field(default="/app/weights", description="模型权重目录")
     outputs_dir: str = Field(default="/app/outputs", description="推理输出目录")
+    preload_blend_plans: bool = Field(default=False, description="启动时预热全景拼接融合计划（冷启动约 14 秒，并写入约 100MB 的 blend_plan_path）；false 时在首次拼接时按需计算、不落盘")
+    blend_plan_path: Optional[str] = Field(default="./cache/blend_plans.npz", description="全景拼接融合计划（blend plan）缓存文件，preload_blend_plans 时启动加载，不存在则计算后写入；相对路径时基于 project_root，置空则不落盘")
     hf_home: Optional[str] = Field(default="./cache/huggingface", description="HuggingFace 缓存目录，供 CLIPTokenizer 等使用；相对路径时基于 project_root")
 
     # 日志
@@ -43,6 +59,15 @@ class Settings(BaseSettings):
     oss_bucket_name: Optional[str] = Field(default=None, description="OSS Bucket 名称")
     oss_bucket_domain: Optional[str] = Field(default=None, description="自定义域名或公网访问域名，用于返回可访问 URL；不填则用 endpoint 拼 bucket 域名")
 
+    @field_validator("pano_ladder")
+    @classmethod
+    def _check_pano_ladder(cls, widths: List[int]) -> List[int]:
+        # 启动时校验，避免错误的宽度在整次推理结束、拼接时才报错
+        for width in widths:
+            if width <= 0 or width > PANO_WIDTH or PANO_WIDTH % width:
+                raise ValueError(f"pano_ladder 宽度 {width} 无效：需为不超过 {PANO_WIDTH} 且整除 {PANO_WIDTH} 的正整数")
+        return widths
+
 
 def get_settings() -> Settings:
     return Settings()
@@ -4,7 +4,7 @@
 """
 import logging
 import os
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from app.config import Settings
 from app.core.inference import InferenceResult, InferenceService
@@ -20,20 +20,36 @@ def _run_in_process(
     image_path: Optional[str] = None,
     gen_video: bool = False,
     text_path: Optional[str] = None,
-) -> Tuple[bool, Optional[str], Optional[List[str]], str]:
-    """进程内调用 app 内封装的 run_inference，返回 (success, output_dir, image_paths, message)。"""
+    video_workers: Optional[int] = None,
+    video_queue_depth: Optional[int] = None,
+    stitch_backend: str = "opencv",
+    stitch_device: Optional[str] = None,
+    stitch_memory_mb: Optional[int] = None,
+    pano_ladder: Sequence[int] = (),
+    pano_format: str = "equirect",
+    cube_face_size: int = 1024,
+) -> Tuple[bool, Optional[str], Optional[List[str]], Optional[List[Dict[str, Any]]], Optional[List[str]], str]:
+    """进程内调用 app 内封装的 run_inference，返回 (success, output_dir, image_paths, pano_levels, cubemap_paths, message)。"""
     try:
-        output_dir, image_paths = run_pano_inference(
+        output_dir, image_paths, pano_levels, cubemap_paths = run_pano_inference(
             project_root=project_root,
             text=text,
             image_path=image_path,
             gen_video=gen_video,
             text_path=text_path,
+            video_workers=video_workers,
+            video_queue_depth=video_queue_depth,
+            stitch_backend=stitch_backend,
+            stitch_device=stitch_device,
+            stitch_memory_mb=stitch_memory_mb,
+            pano_ladder=pano_ladder,
+            pano_format=pano_format,
+            cube_face_size=cube_face_size,
         )
-        return True, output_dir, image_paths, ""
+        return True, output_dir, image_paths, pano_levels, cubemap_paths, ""
     except Exception as e:
         logger.exception("进程内推理异常: %s", e)
-        return False, None, None, str(e)
+        return False, None, None, None, None, str(e)
 
 
 class DemoInProcessInferenceService(InferenceService):
@@ -56,12 +72,20 @@ class DemoInProcessInferenceService(InferenceService):
         if mode == "outpaint" and not image_path:
             return InferenceResult(success=False, message="outpaint 模式需提供 image_path")
         logger.info("进程内推理 mode=%s text 长度=%d", mode, len(text or ""))
-        success, output_dir, image_paths, message = _run_in_process(
+        success, output_dir, image_paths, pano_levels, cubemap_paths, message = _run_in_process(
             project_root=self.settings.project_root,
             text=text,
             image_path=image_path,
             gen_video=gen_video,
             text_path=text_path,
+            video_workers=self.settings.video_workers,
+            video_queue_depth=self.settings.video_queue_depth,
+            stitch_backend=self.settings.stitch_backend,
+            stitch_device=self.settings.stitch_device,
+            stitch_memory_mb=self.settings.stitch_memory_mb,
+            pano_ladder=self.settings.pano_ladder,
+            pano_format=self.settings.pano_format,
+            cube_face_size=self.settings.cube_face_size,
         )
         if not success:
             return InferenceResult(success=False, message=message or "推理失败")
@@ -69,7 +93,7 @@ class DemoInProcessInferenceService(InferenceService):
         logger.info("[进度] 推理成功，准备上传 OSS（若已配置）...")
         pano_oss_url: Optional[str] = None
         pano_path = os.path.join(output_dir, "pano.png") if output_dir else None
-        if pano_path and self.settings.oss_endpoint and self.settings.oss_access_key_id:
+        if pano_path and os.path.isfile(pano_path) and self.settings.oss_endpoint and self.settings.oss_access_key_id:
             pano_oss_url = upload_pano_to_oss(
                 pano_path,
                 user_id or "default",
@@ -86,4 +110,6 @@ class DemoInProcessInferenceService(InferenceService):
             output_dir=output_dir,
             image_paths=image_paths,
             pano_oss_url=pano_oss_url,
+            pano_levels=pano_levels,
+            cubemap_paths=cubemap_paths or None,
         )
@@ -5,7 +5,7 @@
 import logging
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +17,8 @@ class InferenceResult:
     output_dir: Optional[str] = None
     image_paths: Optional[List[str]] = None
     pano_oss_url: Optional[str] = None
+    pano_levels: Optional[List[Dict[str, Any]]] = None  # [{width, height, path}]，按宽度升序
+    cubemap_paths: Optional[List[str]] = None  # 六面体贴图，front/right/back/left/up/down 顺序
     message: Optional[str] = None
 
 
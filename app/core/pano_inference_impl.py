@@ -11,7 +11,7 @@ import cv2
 import torch
 from pathlib import Path
 from datetime import datetime
-from typing import List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "True")
 torch.manual_seed(0)
@@ -86,6 +86,42 @@ def preload_models(project_root: str) -> None:
         logger.info("[进度] 预加载外扩模型...")
         _loaded_models[key_o] = _load_outpaint(project_root)
         logger.info("[进度] 外扩模型预加载完成")
+    # 两个模型共用同一 8 视角相机组，对应关系缓存只需预热一次
+    config, _ = _loaded_models[key_t]
+    _warm_correspondences(config["dataset"]["resolution"])
+
+
+def _warm_correspondences(resolution: int) -> None:
+    """
+    预热全景模型的像素对应关系缓存（src.models.pano.utils.correspondence_cache），并预先生成 UNet 四个特征层级
+    （1/8 到 1/64 分辨率）的 CPAttn 采样计划。无分类器引导的两半 batch 共用同一份几何（geometry_groups），
+    这里按单份 R/K 计算，使首个请求的每个去噪步都直接命中缓存。
+    """
+    from src.models.pano.utils import cached_correspondences
+
+    K_t, R_t = _rig_K_R(resolution)
+    with torch.no_grad():
+        correspondences = cached_correspondences(R_t, K_t, resolution, resolution)
+        for scale in (8, 16, 32, 64):
+            correspondences.sampling_plan(resolution // scale, resolution // scale)
+    logger.info("[进度] 视角对应关系缓存预热完成 resolution=%d", resolution)
+
+
+def preload_blend_plans(
+    project_root: str, cache_path: Optional[str] = None, cube_face_size: Optional[int] = None
+) -> None:
+    """
+    启动时预热全景拼接的融合计划（blend plan，进程内共享），给定 cube_face_size 时同时预热六面体贴图的计划。
+    cache_path 中已有的计划直接从磁盘加载，缺少的计算后写回该文件，供下次启动复用；相对路径基于 project_root。
+    """
+    _ensure_project_root_in_path(project_root)
+    from generate_video_tool.pano_video_generation import preload_blend_plans as _preload
+
+    if cache_path and not Path(cache_path).is_absolute():
+        cache_path = str(Path(project_root).resolve() / cache_path)
+    logger.info("[进度] 预热全景拼接融合计划 cache_path=%s ...", cache_path)
+    _preload(cache_path, cube_face_size=cube_face_size)
+    logger.info("[进度] 全景拼接融合计划预热完成")
 
 
 def _get_K_R(FOV: float, THETA: float, PHI: float, height: int, width: int) -> Tuple[np.ndarray, np.ndarray]:
@@ -101,6 +137,19 @@ def _get_K_R(FOV: float, THETA: float, PHI: float, height: int, width: int) -> T
     return K, R
 
 
+def _rig_K_R(resolution: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """8 视角相机组（FOV 90，每 45° 一个视角）的 K、R，形状 (1, 8, 3, 3)，位于 GPU。"""
+    Rs, Ks = [], []
+    for i in range(8):
+        degree = (45 * i) % 360
+        K, R = _get_K_R(90, degree, 0, resolution, resolution)
+        Rs.append(R)
+        Ks.append(K)
+    K_t = torch.tensor(np.array(Ks)).float().cuda()[None]
+    R_t = torch.tensor(np.array(Rs)).float().cuda()[None]
+    return K_t, R_t
+
+
 def _resize_and_center_crop(img: np.ndarray, size: int) -> np.ndarray:
     H, W, _ = img.shape
     if H == W:
@@ -124,12 +173,29 @@ def run_inference(
     image_path: Optional[str] = None,
     gen_video: bool = False,
     text_path: Optional[str] = None,
-) -> Tuple[str, List[str]]:
+    video_workers: Optional[int] = None,
+    video_queue_depth: Optional[int] = None,
+    stitch_backend: str = "opencv",
+    stitch_device: Optional[str] = None,
+    stitch_memory_mb: Optional[int] = None,
+    pano_ladder: Sequence[int] = (),
+    pano_format: str = "equirect",
+    cube_face_size: int = 1024,
+) -> Tuple[str, List[str], List[Dict[str, Any]], List[str]]:
     """
     执行全景推理（与 demo 逻辑一致）。仅在 app 内使用，不依赖 demo.py。
-    :return: (output_dir, image_paths)
+    video_workers / video_queue_depth 配置 video.mp4 渲染流水线的并发与队列深度。
+    stitch_backend 为 "torch" 时 pano.png / video.mp4 在 stitch_device 上用 grid_sample 投影（默认与模型同一设备），默认 OpenCV。
+    stitch_memory_mb 给定时按该缓冲上限分条拼接，pano.png 逐条流式写出，峰值内存与全景分辨率无关。
+    pano_ladder 为额外输出的全景图宽度（pano_<宽度>.png），与 pano.png 由同一次融合逐条缩放得到。
+    pano_format：equirect 输出 pano.png；cubemap 由 8 张视角图直接生成六面体贴图 cube_<面>.png
+    （边长 cube_face_size，不经过等距柱状投影中间图）；both 两者都输出。gen_video 时总会生成 pano.png。
+    :return: (output_dir, image_paths, pano_levels, cubemap_paths)，pano_levels 为 [{width, height, path}]，
+        按宽度升序；cubemap_paths 按 front/right/back/left/up/down 顺序，未输出时为空列表
     :raises: Exception on failure
     """
+    if pano_format not in ("equirect", "cubemap", "both"):
+        raise ValueError(f"未知的全景输出格式: {pano_format}")
     mode = "outpaint" if (image_path and image_path.strip()) else "text2pano"
     logger.info("[进度] 开始全景推理 mode=%s", mode)
 
@@ -145,6 +211,9 @@ def run_inference(
             _loaded_models[cache_key] = _load_outpaint(project_root)
 
     config, model = _loaded_models[cache_key]
+    if stitch_device is None:
+        # torch 拼接后端默认与模型同一设备（模型在 GPU 上时即在 GPU 上投影）
+        stitch_device = str(model.device)
     img = None
 
     if image_path and image_path.strip():
@@ -171,12 +240,7 @@ def run_inference(
             pass
 
     resolution = config["dataset"]["resolution"]
-    Rs, Ks = [], []
-    for i in range(8):
-        degree = (45 * i) % 360
-        K, R = _get_K_R(90, degree, 0, resolution, resolution)
-        Rs.append(R)
-        Ks.append(K)
+    K_t, R_t = _rig_K_R(resolution)
 
     images = torch.zeros((1, 8, resolution, resolution, 3)).float().cuda()
     if img is not None:
@@ -191,8 +255,6 @@ def run_inference(
     else:
         prompt = [text] * 8
 
-    K_t = torch.tensor(Ks).float().cuda()[None]
-    R_t = torch.tensor(Rs).float().cuda()[None]
     batch = {"images": images, "prompt": prompt, "R": R_t, "K": K_t}
     logger.info("[进度] 开始模型推理（8 视角生成，耗时较长）...")
     images_pred = model.inference(batch)
@@ -202,6 +264,7 @@ def run_inference(
     out_dir.mkdir(parents=True, exist_ok=True)
     (out_dir / "prompt.txt").write_text(text, encoding="utf-8")
     image_paths = []
+    views_bgr = []
     for i in range(8):
         from PIL import Image
         arr = images_pred[0, i]
@@ -212,12 +275,26 @@ def run_inference(
         p = out_dir / f"{i}.png"
         im.save(str(p))
         image_paths.append(str(p))
+        views_bgr.append(np.ascontiguousarray(arr[..., ::-1]))
     logger.info("[进度] 8 张视角图已保存，生成全景图 pano.png ...")
 
-    # 与 demo.py 一致：始终调用 generate_video 以生成 pano.png，gen_video 仅控制是否生成 video.mp4
-    from generate_video_tool.pano_video_generation import generate_video
-    generate_video(image_paths, str(out_dir), gen_video)
-    image_paths.append(str(out_dir / "pano.png"))
+    # 与 demo.py 一致：generate_video 生成 pano.png，gen_video 仅控制是否生成 video.mp4（仅 cubemap 且不要视频时跳过）
+    # 视角图直接以内存中的 BGR 数组传入，不再从刚写出的 PNG 读回
+    from generate_video_tool.pano_video_generation import (
+        generate_cubemap, generate_video, pano_levels as pano_level_paths)
+    memory_budget = stitch_memory_mb * (1 << 20) if stitch_memory_mb else None
+    pano_levels: List[Dict[str, Any]] = []
+    if pano_format != "cubemap" or gen_video:
+        generate_video(views_bgr, str(out_dir), gen_video,
+                       num_workers=video_workers, queue_depth=video_queue_depth,
+                       backend=stitch_backend, device=stitch_device,
+                       memory_budget=memory_budget, ladder=pano_ladder)
+        image_paths.append(str(out_dir / "pano.png"))
+        pano_levels = [{"width": w, "height": h, "path": p} for w, h, p in pano_level_paths(str(out_dir), pano_ladder)]
+    cubemap_paths: List[str] = []
+    if pano_format != "equirect":
+        logger.info("[进度] 生成六面体贴图 face_size=%d ...", cube_face_size)
+        cubemap_paths = generate_cubemap(views_bgr, str(out_dir), cube_face_size, memory_budget=memory_budget)
     logger.info("[进度] 全景推理完成 output_dir=%s", out_dir)
 
-    return str(out_dir), image_paths
+    return str(out_dir), image_paths, pano_levels, cubemap_paths
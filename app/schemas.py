@@ -9,6 +9,13 @@ from pydantic import BaseModel, Field
 InferenceMode = Literal["text2pano", "outpaint"]
 
 
+class PanoLevel(BaseModel):
+    """全景图的一个分辨率层级。"""
+    width: int = Field(..., description="宽度（像素）")
+    height: int = Field(..., description="高度（像素）")
+    path: str = Field(..., description="图片路径，全分辨率为 pano.png，其余为 pano_<宽度>.png")
+
+
 class TaskMessage(BaseModel):
     """从任务队列消费的消息。"""
     task_id: str = Field(..., description="任务唯一标识")
@@ -27,6 +34,8 @@ class ResultMessage(BaseModel):
     output_dir: Optional[str] = Field(default=None, description="输出目录路径")
     image_paths: Optional[List[str]] = Field(default=None, description="生成图片路径列表")
     pano_oss_url: Optional[str] = Field(default=None, description="全景图 pano.png 上传 OSS 后的可访问 URL")
+    pano_levels: Optional[List[PanoLevel]] = Field(default=None, description="全景图各分辨率层级，按宽度升序")
+    cubemap_paths: Optional[List[str]] = Field(default=None, description="六面体贴图路径，按 front/right/back/left/up/down 顺序")
     message: Optional[str] = Field(default=None, description="错误或状态信息")
 
 
@@ -54,6 +54,8 @@ def _run_worker(
                 output_dir=result.output_dir,
                 image_paths=result.image_paths,
                 pano_oss_url=result.pano_oss_url,
+                pano_levels=result.pano_levels,
+                cubemap_paths=result.cubemap_paths,
                 message=result.message,
             )
             redis.lpush(settings.result_queue, result_msg.model_dump_json())
@@ -0,0 +1,37 @@
+import platform
+import os
+import time
+import torch
+
+
+def device_sync(device):
+    device = torch.device(device)
+    return (lambda: torch.cuda.synchronize(device)) if device.type == 'cuda' else (lambda: None)
+
+
+def timeit(fn, repeat, sync=lambda: None):
+    """(ms of the first call, mean ms of `repeat` further calls, last output)."""
+    t = time.perf_counter()
+    out = fn()
+    sync()
+    first = (time.perf_counter() - t) * 1000
+    t = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    sync()
+    return first, (time.perf_counter() - t) / max(repeat, 1) * 1000, out
+
+
+def environment(device):
+    device = torch.device(device)
+    return {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'device': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+    }
+
+
+def max_diff(a, b):
+    return (a.float() - b.float()).abs().max().item()
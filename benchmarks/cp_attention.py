@@ -0,0 +1,58 @@
+"""
+Single-query attention of the CP blocks: CrossAttention's einsum path against the fused
+scaled_dot_product_attention path, time per call and max difference, at the pano (18 keys) and depth
+(k padded neighbor keys, masked) shapes of every UNet level.
+
+    python -m benchmarks.cp_attention [--device cuda] [--half] [--repeat 10]
+"""
+import argparse
+import torch
+from src.models.modules.transformer import CrossAttention
+from benchmarks.common import device_sync, environment, max_diff, timeit
+
+# (name, rows, dim, keys, masked) of one call at the guidance pair batch (b=2): pano and depth CPAttn both attend
+# over all views at once, rows = b*m*h*w (pano: 8 views of 512x512, depth: 12 views of 256x192)
+CASES = [('pano {0}x{0}'.format(s), 2*8*s*s, dim, 18, False) for s, dim in ((64, 320), (32, 640), (16, 1280), (8, 1280))] + \
+    [('depth {}x{}'.format(w, h), 2*12*h*w, dim, 11, True) for (h, w), dim in (((24, 32), 320), ((12, 16), 640),
+                                                                             ((6, 8), 1280), ((3, 4), 1280))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--half', action='store_true', help='float16 (cuda)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--cases', nargs='*', default=None, help='substrings of the case names to run')
+    args = parser.parse_args()
+    sync = device_sync(args.device)
+    dtype = torch.float16 if args.half else torch.float32
+    print(environment(args.device))
+    print('{:>14} {:>10} {:>10} {:>8} {:>10}'.format('case', 'einsum ms', 'fused ms', 'speedup', 'max diff'))
+
+    with torch.no_grad():
+        for name, rows, dim, keys, masked in CASES:
+            if args.cases and not any(c in name for c in args.cases):
+                continue
+            torch.manual_seed(0)
+            attn = CrossAttention(dim, context_dim=dim, heads=dim//32, dim_head=32)
+            for param in attn.parameters():
+                param.normal_(0, dim ** -0.5)
+            attn = attn.to(args.device, dtype).eval()
+            x = torch.randn(rows, 1, dim, device=args.device, dtype=dtype)
+            context = torch.randn(rows, keys, dim, device=args.device, dtype=dtype)
+            mask = None
+            if masked:
+                # neighbor counts between 1 and keys, like padded depth neighbor sets
+                count = torch.randint(1, keys+1, (rows, 1), device=args.device)
+                mask = torch.arange(keys, device=args.device)[None] < count
+
+            attn.fused = False
+            _, einsum_ms, ref = timeit(lambda: attn(x, context, mask), args.repeat, sync)
+            attn.fused = True
+            _, fused_ms, out = timeit(lambda: attn(x, context, mask), args.repeat, sync)
+            print('{:>14} {:>10.2f} {:>10.2f} {:>7.1f}x {:>10.2e}'.format(
+                name, einsum_ms, fused_ms, einsum_ms / fused_ms, max_diff(out, ref)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+One CP transformer block (BasicTransformerBlock) per call: the checkpointed forward under torch.no_grad (the
+sampling path before inference mode) against the inference path under torch.inference_mode (no checkpoint, fused
+residuals and GEGLU gate, single_query_attention), time per call and max difference, at the pano and depth shapes
+of every UNet level.
+
+    python -m benchmarks.cp_block [--device cuda] [--half] [--repeat 10]
+"""
+import argparse
+import torch
+from src.models.modules.transformer import BasicTransformerBlock
+from benchmarks.common import device_sync, environment, max_diff, timeit
+from benchmarks.cp_attention import CASES
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--half', action='store_true', help='float16 (cuda)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--cases', nargs='*', default=None, help='substrings of the case names to run')
+    args = parser.parse_args()
+    sync = device_sync(args.device)
+    dtype = torch.float16 if args.half else torch.float32
+    print(environment(args.device))
+    print('{:>14} {:>10} {:>10} {:>8} {:>10}'.format('case', 'no_grad ms', 'infer ms', 'speedup', 'max diff'))
+
+    for name, rows, dim, keys, masked in CASES:
+        if args.cases and not any(c in name for c in args.cases):
+            continue
+        torch.manual_seed(0)
+        block = BasicTransformerBlock(dim, dim//32, 32, context_dim=dim).to(args.device, dtype).eval()
+        x = torch.randn(rows, 1, dim, device=args.device, dtype=dtype)
+        query_pe = torch.randn(rows, 1, dim, device=args.device, dtype=dtype)
+        context = torch.randn(rows, keys, dim, device=args.device, dtype=dtype)
+        mask = None
+        if masked:
+            count = torch.randint(1, keys+1, (rows, 1), device=args.device)
+            mask = torch.arange(keys, device=args.device)[None] < count
+
+        with torch.no_grad():
+            _, no_grad_ms, ref = timeit(lambda: block(x, context, query_pe, mask), args.repeat, sync)
+        # what inference_mode switches on
+        block.inference = block.attn1.fused = True
+        with torch.inference_mode():
+            _, inference_ms, out = timeit(lambda: block(x, context, query_pe, mask), args.repeat, sync)
+        block.inference = block.attn1.fused = False
+        print('{:>14} {:>10.2f} {:>10.2f} {:>7.1f}x {:>10.2e}'.format(
+            name, no_grad_ms, inference_ms, no_grad_ms / inference_ms, max_diff(out, ref)))
+
+
+if __name__ == '__main__':
+    main()
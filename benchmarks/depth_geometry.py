@@ -0,0 +1,91 @@
+"""
+Depth-check gather of the depth model's CPAttn geometry: the former per (batch item, view, neighbor)
+get_key_value loop (reproduced in loop_level) against the batched depth_check, at the four UNet
+resolutions of the ScanNet configs.
+
+    python -m benchmarks.depth_geometry [--device cuda] [--views 12] [--repeat 10]
+"""
+import argparse
+import math
+import torch
+from src.models.depth.utils import get_geometry
+from benchmarks.common import device_sync, environment, max_diff, timeit
+
+# configs/depth_generation_*.yaml
+IMAGE_H, IMAGE_W = 192, 256
+# latent (1/8) and the three downsampled UNet levels
+LEVELS = [(IMAGE_H//s, IMAGE_W//s) for s in (8, 16, 32, 64)]
+
+
+def synthetic_scene(b, m, device, seed=0):
+    """A camera panning over a noisy depth field, with some missing depth like ScanNet."""
+    g = torch.Generator().manual_seed(seed)
+    K = torch.tensor([[IMAGE_W/2, 0, IMAGE_W/2, 0], [0, IMAGE_W/2, IMAGE_H/2, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+    poses = torch.eye(4).repeat(b, m, 1, 1)
+    for i in range(m):
+        a = i * 0.08
+        poses[:, i, 0, 0] = poses[:, i, 2, 2] = math.cos(a)
+        poses[:, i, 0, 2], poses[:, i, 2, 0] = math.sin(a), -math.sin(a)
+        poses[:, i, 0, 3] = 0.05 * i
+    depths = 1.5 + torch.rand(b, m, IMAGE_H, IMAGE_W, generator=g)
+    depths[depths < 1.55] = 0
+    return poses.to(device), K[None].repeat(b, 1, 1).to(device), depths.to(device)
+
+
+def loop_level(geometry, h, w):
+    # the gather as it was: one call per (batch item, view, neighbor), depths looked up per batch item
+    k = geometry.neighbor_index.shape[-1]
+    scale = IMAGE_H//h
+    grids, xy_rel, mask = [], [], []
+    for b_i, neighbors in enumerate(geometry.neighbors):
+        for i, indexs in enumerate(neighbors):
+            out = []
+            for j in indexs:
+                xy_l = geometry.correspondence[b_i:b_i+1, i, j, scale//2::scale, scale//2::scale]/scale-0.5
+                xy_l_rescale = (xy_l+0.5)*scale
+                xy_l_round = xy_l_rescale.round().long()
+                _mask = (xy_l_round[..., 0] >= 0)*(xy_l_round[..., 0] < IMAGE_W) * (
+                    xy_l_round[..., 1] >= 0)*(xy_l_round[..., 1] < IMAGE_H)
+                xy_l_round[..., 0] = torch.clamp(xy_l_round[..., 0], 0, IMAGE_W-1)
+                xy_l_round[..., 1] = torch.clamp(xy_l_round[..., 1], 0, IMAGE_H-1)
+                depths = geometry.depths[b_i:b_i+1, j]
+                depth_i = torch.stack([depths[n, xy_l_round[n, ..., 1], xy_l_round[n, ..., 0]] for n in range(1)])
+                _mask = _mask*(depth_i > 0)
+                depth_i[~_mask] = 1000000
+                depth_query = geometry.depths[b_i:b_i+1, i, scale//2::scale, scale//2::scale]
+                xy_l[..., 0] = xy_l[..., 0]/(w-1)*2-1
+                xy_l[..., 1] = xy_l[..., 1]/(h-1)*2-1
+                out.append((xy_l, (depth_query-depth_i).abs()[..., None], _mask*(depth_query > 0)))
+            pad = k-len(indexs)
+            for dst, t in zip((grids, xy_rel, mask), zip(*out)):
+                t = torch.stack(t, dim=1)
+                dst.append(torch.cat([t, t.new_zeros(1, pad, *t.shape[2:])], dim=1))
+    return [torch.cat(t).reshape(len(geometry.neighbors), -1, *t[0].shape[1:]) for t in (grids, xy_rel, mask)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch', type=int, default=2, help='2 = one view set with classifier-free guidance')
+    parser.add_argument('--views', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    sync = device_sync(args.device)
+
+    with torch.no_grad():
+        geometry = get_geometry(*synthetic_scene(args.batch, args.views, args.device), overlap_filter=0.3)
+        print(environment(args.device))
+        print('b={} m={} k={}'.format(args.batch, args.views, geometry.neighbor_index.shape[-1]))
+        print('{:>8} {:>10} {:>10} {:>8} {:>10}'.format('level', 'loop ms', 'batched ms', 'speedup', 'max diff'))
+        valid = geometry.neighbor_valid[..., None, None]
+        for h, w in LEVELS:
+            _, loop_ms, ref = timeit(lambda: loop_level(geometry, h, w), args.repeat, sync)
+            _, ms, level = timeit(lambda: geometry._build_level(IMAGE_H, IMAGE_W, h, w), args.repeat, sync)
+            diff = max(max_diff(level.grids*valid[..., None], ref[0]), max_diff(level.xy_rel*valid[..., None], ref[1]),
+                       max_diff(level.mask, ref[2]))
+            print('{:>8} {:>10.2f} {:>10.2f} {:>7.1f}x {:>10.2e}'.format(
+                '{}x{}'.format(w, h), loop_ms, ms, loop_ms / ms, diff))
+
+
+if __name__ == '__main__':
+    main()
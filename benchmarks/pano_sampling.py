@@ -0,0 +1,65 @@
+"""
+3x3 kernel sampling of pano CPAttn (sample_key_value): one grid_sample per kernel offset against the single
+grid_sample over the stacked offset grids, time per call and max difference, at the four UNet feature
+resolutions of 512x512 views. Inputs are shaped like CPSamplingPlan.sample: the m*n (view, neighbor) pairs of
+the 8 view rig, --groups batch groups (2 for the guidance halves) folded into channels.
+
+    python -m benchmarks.pano_sampling [--device cuda] [--half] [--groups 2] [--repeat 10]
+"""
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from src.models.pano.utils import get_neighbor_correspondences, sample_key_value
+from benchmarks.common import device_sync, environment, max_diff, timeit
+
+# (feature size, channels) of the UNet levels
+LEVELS = [(64, 320), (32, 640), (16, 1280), (8, 1280)]
+
+
+def sample_key_value_loop(key_value, grids):
+    return torch.stack([F.grid_sample(key_value, grids[:, k], align_corners=True)
+                        for k in range(grids.shape[1])], dim=1)
+
+
+def rig(resolution, device):
+    """R, K of the 8 view, 45 degree yaw rig (b=1)."""
+    f = 0.5 * resolution / np.tan(np.deg2rad(45))
+    K = torch.tensor([[f, 0, resolution/2], [0, f, resolution/2], [0, 0, 1]], dtype=torch.float32)
+    R = []
+    for i in range(8):
+        t = np.deg2rad(45 * i)
+        R.append(torch.tensor([[np.cos(t), 0, np.sin(t)], [0, 1, 0], [-np.sin(t), 0, np.cos(t)]], dtype=torch.float32))
+    return torch.stack(R)[None].to(device), K[None, None].repeat(1, 8, 1, 1).to(device)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--half', action='store_true', help='float16 (cuda)')
+    parser.add_argument('--groups', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    sync = device_sync(args.device)
+    dtype = torch.float16 if args.half else torch.float32
+    print(environment(args.device))
+    print('{:>8} {:>10} {:>10} {:>8} {:>10}'.format('level', 'loop ms', 'single ms', 'speedup', 'max diff'))
+
+    R, K = rig(512, args.device)
+    correspondences = get_neighbor_correspondences(R, K, 512, 512)
+    with torch.no_grad():
+        for size, dim in LEVELS:
+            plan = correspondences.sampling_plan(size, size)
+            n = plan.neighbor_index.shape[1]
+            grids = plan.grids.reshape(-1, n, 9, size, size, 2).flatten(0, 1).to(dtype)
+            torch.manual_seed(0)
+            key_value = torch.randn(grids.shape[0], args.groups*dim, size, size, device=args.device, dtype=dtype)
+
+            _, loop_ms, ref = timeit(lambda: sample_key_value_loop(key_value, grids), args.repeat, sync)
+            _, single_ms, out = timeit(lambda: sample_key_value(key_value, grids), args.repeat, sync)
+            print('{:>8} {:>10.2f} {:>10.2f} {:>7.1f}x {:>10.2e}'.format(
+                '{0}x{0}'.format(size), loop_ms, single_ms, loop_ms / single_ms, max_diff(out, ref)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import cv2
+
+
+def timeit(fn, repeat, sync=lambda: None):
+    """
+    (ms of the first call, mean ms of `repeat` further calls, last output). Same as the repository level
+    benchmarks.common.timeit, kept here so the stitching cases never import torch (it would dominate peak_rss_mb).
+    """
+    t = time.perf_counter()
+    out = fn()
+    sync()
+    first = (time.perf_counter() - t) * 1000
+    t = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    sync()
+    return first, (time.perf_counter() - t) / max(repeat, 1) * 1000, out
+
+
+def synthetic_views(n, size, seed=0):
+    # smooth gradients plus noise, so cubic interpolation differences show up in the diff
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    views = []
+    for i in range(n):
+        base = np.stack([x * 255, y * 255, (x + y + i / n) % 1 * 255], axis=-1)
+        views.append(np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8))
+    return views
+
+
+def rss_mb():
+    """Current resident set size in MB (Linux), None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'opencv_threads': cv2.getNumThreads(),
+    }
+
+
+def save_json(path, data):
+    # sorted keys and one entry per line keep baselines diffable between commits
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,55 @@
+"""
+OpenCV vs torch (grid_sample) projection backends: time per call and difference of the outputs.
+
+    cd generate_video_tool && python -m benchmarks.projection_backends [--device cuda] [--threads 8]
+"""
+import argparse
+import os
+import sys
+import numpy as np
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.Perspec2Equirec as P2E
+import lib.Equirec2Perspec as E2P
+import lib.multi_Perspec2Equirec as m_P2E
+import lib.blend_plan as blend_plan
+from pano_video_generation import PANO_RIG, PANO_HEIGHT, PANO_WIDTH, PANO_ROWS
+from benchmarks.common import synthetic_views, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--view_size', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    sync = (lambda: torch.cuda.synchronize(device)) if device.type == 'cuda' else (lambda: None)
+
+    views = synthetic_views(len(PANO_RIG), args.view_size)
+    blend_plan.get_blend_plan(PANO_RIG, args.view_size, args.view_size, PANO_HEIGHT, PANO_WIDTH, PANO_ROWS)
+    equ = E2P.Equirectangular(m_P2E.Perspective(views, PANO_RIG).GetEquirec(
+        PANO_HEIGHT, PANO_WIDTH, PANO_ROWS).astype(np.uint8), full_height=PANO_HEIGHT, row_offset=PANO_ROWS[0])
+
+    cases = {
+        'multi_Perspec2Equirec.GetEquirec': lambda backend: m_P2E.Perspective(views, PANO_RIG).GetEquirec(
+            PANO_HEIGHT, PANO_WIDTH, PANO_ROWS, backend=backend, device=device),
+        'Perspec2Equirec.GetEquirec': lambda backend: P2E.Perspective(views[1], 90, 45, 0).GetEquirec(
+            PANO_HEIGHT // 2, PANO_WIDTH // 2, backend=backend, device=device)[0],
+        'Equirec2Perspec.GetPerspective': lambda backend: equ.GetPerspective(
+            60, 30, 10, 450, 600, backend=backend, device=device),
+    }
+    print(f'device={device} torch_threads={torch.get_num_threads()} view_size={args.view_size}')
+    print(f'{"case":34s} {"opencv ms":>10s} {"torch ms":>10s} {"max diff":>9s} {"mean diff":>9s}')
+    for name, fn in cases.items():
+        _, ms_cv, out_cv = timeit(lambda: fn('opencv'), args.repeat, sync)
+        _, ms_t, out_t = timeit(lambda: fn('torch'), args.repeat, sync)
+        diff = np.abs(np.asarray(out_cv, np.float32) - np.asarray(out_t, np.float32))
+        print(f'{name:34s} {ms_cv:10.1f} {ms_t:10.1f} {diff.max():9.2f} {diff.mean():9.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Benchmark suite of the projection / stitching toolchain on synthetic 512x512 views.
+
+Reports, per case and pano resolution, the first call (cold caches), ms per warm call, output
+megapixels per second and the peak RSS of a fresh process running only that case. Results can be
+saved as JSON baselines and compared against a previous run. Baselines are machine specific and not
+committed: record one from the commit under test, on the pinned requirements, then compare against it:
+
+    cd generate_video_tool
+    python -m benchmarks.stitching --out benchmarks/baselines/stitching.json
+    python -m benchmarks.stitching --compare benchmarks/baselines/stitching.json
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import common
+
+VIEW_SIZE = 512
+DEFAULT_SIZES = ['512x1024', '1024x2048', '2048x4096']
+
+
+def _p2e(height, width, views):
+    import lib.Perspec2Equirec as P2E
+    return lambda: P2E.Perspective(views[1], 90, 45, 0).GetEquirec(height, width), height * width
+
+
+def _e2p(height, width, views):
+    import lib.Equirec2Perspec as E2P
+    pano = np.ascontiguousarray(np.resize(np.concatenate(views, axis=1), (height, width, 3)))
+    equ = E2P.Equirectangular(pano)
+    return lambda: equ.GetPerspective(60, 30, 10, VIEW_SIZE, VIEW_SIZE), VIEW_SIZE * VIEW_SIZE
+
+
+def _multi_p2e(height, width, views):
+    import lib.multi_Perspec2Equirec as m_P2E
+    from pano_video_generation import PANO_RIG
+    return lambda: m_P2E.Perspective(views, PANO_RIG).GetEquirec(height, width), height * width
+
+
+def _multi_p2e_tiled(height, width, views):
+    import lib.multi_Perspec2Equirec as m_P2E
+    from pano_video_generation import PANO_RIG
+
+    def run():
+        for _ in m_P2E.Perspective(views, PANO_RIG).GetEquirecStrips(height, width, memory_budget=16 << 20):
+            pass
+    return run, height * width
+
+
+def _cubemap(height, width, views):
+    import lib.multi_Perspec2Cubemap as m_P2C
+    from pano_video_generation import PANO_RIG
+    face_size = width // 4
+    return lambda: m_P2C.Perspective(views, PANO_RIG).GetCubemap(face_size), 6 * face_size * face_size
+
+
+def _generate_video(height, width, views, gen_video=False):
+    import pano_video_generation as pvg
+    # generate_video always stitches the fixed PANO_HEIGHT x PANO_WIDTH band
+    if (height, width) != (pvg.PANO_HEIGHT, pvg.PANO_WIDTH):
+        return None
+    out_dir = tempfile.mkdtemp(prefix='bench_pano_')
+    band = (pvg.PANO_ROWS[1] - pvg.PANO_ROWS[0]) * pvg.PANO_WIDTH
+    return lambda: pvg.generate_video(views, out_dir, gen_video, memory_budget=64 << 20), band
+
+
+CASES = {
+    'Perspec2Equirec.GetEquirec': _p2e,
+    'Equirec2Perspec.GetPerspective': _e2p,
+    'multi_Perspec2Equirec.GetEquirec': _multi_p2e,
+    'multi_Perspec2Equirec.GetEquirecStrips': _multi_p2e_tiled,
+    'multi_Perspec2Cubemap.GetCubemap': _cubemap,
+    'generate_video[pano]': _generate_video,
+    'generate_video[pano+video]': lambda h, w, views: _generate_video(h, w, views, gen_video=True),
+}
+
+
+def _run_case(name, height, width, repeat, result):
+    views = common.synthetic_views(8, VIEW_SIZE)
+    setup = CASES[name](height, width, views)
+    if setup is None:
+        result.put(None)
+        return
+    fn, pixels = setup
+    rss_before = common.rss_mb()
+    first_ms, ms, _ = common.timeit(fn, repeat)
+    peak = common.peak_rss_mb()
+    result.put({
+        'first_call_ms': round(first_ms, 2),
+        'ms': round(ms, 2),
+        'mpix_per_s': round(pixels / 1e6 / (ms / 1000), 2) if ms > 0 else None,
+        'peak_rss_mb': round(peak, 1),
+        'rss_growth_mb': round(peak - rss_before, 1) if rss_before is not None else None,
+    })
+
+
+def run_case(name, height, width, repeat):
+    """Run one case in a fresh process, so caches start cold and the peak RSS is its own."""
+    ctx = multiprocessing.get_context('spawn')
+    result = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(name, height, width, repeat, result))
+    proc.start()
+    out = result.get()
+    proc.join()
+    return out
+
+
+def compare(results, baseline):
+    print(f'{"case":50s} {"base ms":>10s} {"ms":>10s} {"change":>8s} {"base MB":>8s} {"MB":>8s}')
+    for key in sorted(set(results) | set(baseline)):
+        new, old = results.get(key), baseline.get(key)
+        if new is None or old is None:
+            print(f'{key:50s} {"only in " + ("baseline" if new is None else "this run"):>48s}')
+            continue
+        change = (new['ms'] / old['ms'] - 1) * 100 if old['ms'] else float('nan')
+        print(f'{key:50s} {old["ms"]:10.1f} {new["ms"]:10.1f} {change:+7.1f}% '
+              f'{old["peak_rss_mb"]:8.1f} {new["peak_rss_mb"]:8.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES), help='pano sizes as HxW, comma separated')
+    parser.add_argument('--cases', default=None, help='comma separated subset of: ' + ', '.join(CASES))
+    parser.add_argument('--repeat', type=int, default=3, help='warm calls timed per case')
+    parser.add_argument('--out', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare against')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',')]
+    names = args.cases.split(',') if args.cases else list(CASES)
+    results = {}
+    print(f'{"case":50s} {"first ms":>10s} {"ms":>10s} {"MP/s":>8s} {"peak MB":>8s} {"+MB":>8s}')
+    for height, width in sizes:
+        for name in names:
+            r = run_case(name, height, width, args.repeat)
+            if r is None:
+                continue
+            key = f'{name}@{height}x{width}'
+            results[key] = r
+            print(f'{key:50s} {r["first_call_ms"]:10.1f} {r["ms"]:10.1f} {r["mpix_per_s"] or 0:8.2f} '
+                  f'{r["peak_rss_mb"]:8.1f} {r["rss_growth_mb"] or 0:8.1f}')
+
+    if args.out:
+        common.save_json(args.out, {'environment': common.environment(), 'view_size': VIEW_SIZE,
+                                    'repeat': args.repeat, 'results': results})
+    if args.compare:
+        compare(results, common.load_json(args.compare)['results'])
+
+
+if __name__ == '__main__':
+    main()
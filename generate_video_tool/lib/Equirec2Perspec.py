@@ -4,7 +4,9 @@ import cv2
 import numpy as np
 
 class Equirectangular:
-    def __init__(self, img_name, text2light=False):
+    def __init__(self, img_name, text2light=False, full_height=None, row_offset=0):
+        # the image may be a row band of a taller equirect: full_height is the height of the
+        # whole equirect and row_offset the index of the first row of the band in it
         if isinstance(img_name, str):
             self._img = cv2.imread(img_name, cv2.IMREAD_COLOR)
         else:
@@ -13,57 +15,100 @@ class Equirectangular:
             self._img = np.roll(self._img, -60, axis=0)
         
         [self._height, self._width, _] = self._img.shape
+        self._full_height = self._height if full_height is None else full_height
+        self._row_offset = row_offset
     
 
-    def GetPerspective(self, FOV, THETA, PHI, height, width):
+    def GetPerspective(self, FOV, THETA, PHI, height, width, backend='opencv', device=None):
         #
         # THETA is left/right angle, PHI is up/down angle, both in degree
+        # backend='torch' samples with grid_sample on device (see lib.torch_projection)
         #
-
-        equ_h = self._height
-        equ_w = self._width
-        equ_cx = (equ_w - 1) / 2.0
-        equ_cy = (equ_h - 1) / 2.0
-
-        wFOV = FOV
-        hFOV = float(height) / width * wFOV
-
-        w_len = np.tan(np.radians(wFOV / 2.0))
-        h_len = np.tan(np.radians(hFOV / 2.0))
-
-
-        x_map = np.ones([height, width], np.float32)
-        y_map = np.tile(np.linspace(-w_len, w_len,width), [height,1])
-        z_map = -np.tile(np.linspace(-h_len, h_len,height), [width,1]).T
-
-        D = np.sqrt(x_map**2 + y_map**2 + z_map**2)
-        xyz = np.stack((x_map,y_map,z_map),axis=2)/np.repeat(D[:, :, np.newaxis], 3, axis=2)
-        
-        y_axis = np.array([0.0, 1.0, 0.0], np.float32)
-        z_axis = np.array([0.0, 0.0, 1.0], np.float32)
-        [R1, _] = cv2.Rodrigues(z_axis * np.radians(THETA))
-        [R2, _] = cv2.Rodrigues(np.dot(R1, y_axis) * np.radians(-PHI))
-
-        xyz = xyz.reshape([height * width, 3]).T
-        xyz = np.dot(R1, xyz)
-        xyz = np.dot(R2, xyz).T
-        lat = np.arcsin(xyz[:, 2])
-        lon = np.arctan2(xyz[:, 1] , xyz[:, 0])
-
-        lon = lon.reshape([height, width]) / np.pi * 180
-        lat = -lat.reshape([height, width]) / np.pi * 180
-
-        lon = lon / 180 * equ_cx + equ_cx
-        lat = lat / 90  * equ_cy + equ_cy
-
-        
-            
-        persp = cv2.remap(self._img, lon.astype(np.float32), lat.astype(np.float32), cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
+        if backend == 'torch':
+            import lib.torch_projection as torch_projection
+            return torch_projection.render_perspectives(self, FOV, [THETA], PHI, height, width, device)[0].cpu().numpy()
+        elif backend != 'opencv':
+            raise ValueError('unknown projection backend: {}'.format(backend))
+        lon, lat = self.GetPerspectiveMap(FOV, THETA, PHI, height, width)
+        persp = cv2.remap(self._img, lon, lat, cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
         return persp
-        
-
-
-
-
-
 
+    def GetPerspectiveMap(self, FOV, THETA, PHI, height, width):
+        # float32 (lon, lat) pixel maps of the perspective view in this equirect, for cv2.remap
+        lon, lat = _perspective_lonlat(FOV, THETA, PHI, height, width)
+        return self._lon_to_x(lon), self._lat_to_y(lat)
+
+    def _lon_to_x(self, lon):
+        equ_cx = (self._width - 1) / 2.0
+        return (lon / 180 * equ_cx + equ_cx).astype(np.float32)
+
+    def _lat_to_y(self, lat):
+        equ_cy = (self._full_height - 1) / 2.0
+        return (lat / 90 * equ_cy + equ_cy - self._row_offset).astype(np.float32)
+
+
+class YawSweep:
+    """
+    Fast renderer of PHI=0 perspective frames of one Equirectangular at many THETA, e.g. a fly-around video.
+    At PHI=0 a yaw change only shifts the longitude of every ray, so the base lon/lat map is computed once
+    and each frame just offsets the longitude (with wrap) before the remap. Buffers can be reused across frames.
+    """
+    def __init__(self, equ, FOV, height, width):
+        self._equ = equ
+        self._height = height
+        self._width = width
+        lon, lat = _perspective_lonlat(FOV, 0, 0, height, width)
+        self._lon = lon.astype(np.float32)
+        self._lat = equ._lat_to_y(lat)
+        equ_cx = (equ._width - 1) / 2.0
+        self._scale = np.float32(equ_cx / 180)
+        self._center = np.float32(equ_cx)
+
+    def new_buffers(self):
+        """Return (lon_buf, frame) buffers to pass to render."""
+        lon_buf = np.empty((self._height, self._width), np.float32)
+        frame = np.empty((self._height, self._width, self._equ._img.shape[2]), self._equ._img.dtype)
+        return lon_buf, frame
+
+    def render(self, THETA, out=None, lon_buf=None):
+        if lon_buf is None:
+            lon_buf = np.empty((self._height, self._width), np.float32)
+        # wrap lon + THETA into [-180, 180) like arctan2 does, then convert to pixels
+        np.add(self._lon, np.float32(THETA + 180), out=lon_buf)
+        np.mod(lon_buf, np.float32(360), out=lon_buf)
+        lon_buf -= np.float32(180)
+        lon_buf *= self._scale
+        lon_buf += self._center
+        return cv2.remap(self._equ._img, lon_buf, self._lat, cv2.INTER_CUBIC, dst=out, borderMode=cv2.BORDER_WRAP)
+
+
+def _perspective_lonlat(FOV, THETA, PHI, height, width):
+    # longitude / latitude in degree of every pixel ray of a perspective view
+    wFOV = FOV
+    hFOV = float(height) / width * wFOV
+
+    w_len = np.tan(np.radians(wFOV / 2.0))
+    h_len = np.tan(np.radians(hFOV / 2.0))
+
+
+    x_map = np.ones([height, width], np.float32)
+    y_map = np.tile(np.linspace(-w_len, w_len,width), [height,1])
+    z_map = -np.tile(np.linspace(-h_len, h_len,height), [width,1]).T
+
+    D = np.sqrt(x_map**2 + y_map**2 + z_map**2)
+    xyz = np.stack((x_map,y_map,z_map),axis=2)/np.repeat(D[:, :, np.newaxis], 3, axis=2)
+    
+    y_axis = np.array([0.0, 1.0, 0.0], np.float32)
+    z_axis = np.array([0.0, 0.0, 1.0], np.float32)
+    [R1, _] = cv2.Rodrigues(z_axis * np.radians(THETA))
+    [R2, _] = cv2.Rodrigues(np.dot(R1, y_axis) * np.radians(-PHI))
+
+    xyz = xyz.reshape([height * width, 3]).T
+    xyz = np.dot(R1, xyz)
+    xyz = np.dot(R2, xyz).T
+    lat = np.arcsin(xyz[:, 2])
+    lon = np.arctan2(xyz[:, 1] , xyz[:, 0])
+
+    lon = lon.reshape([height, width]) / np.pi * 180
+    lat = -lat.reshape([height, width]) / np.pi * 180
+    return lon, lat
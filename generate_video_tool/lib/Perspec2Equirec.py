@@ -20,56 +20,86 @@ class Perspective:
 
     
 
-    def GetEquirec(self,height,width):
+    def GetEquirec(self,height,width,rows=None,backend='opencv',device=None):
         #
         # THETA is left/right angle, PHI is up/down angle, both in degree
+        # rows=(start, stop) renders only that row window of the (height, width) equirect
+        # backend='torch' projects with grid_sample on device (see lib.torch_projection)
         #
-
-        x,y = np.meshgrid(np.linspace(-180, 180,width),np.linspace(90,-90,height))
+        if backend == 'torch':
+            import lib.torch_projection as torch_projection
+            persp, mask = torch_projection.equirec_from_view(self._img, self.wFOV, self.THETA, self.PHI,
+                                                             height, width, rows, device)
+            return persp.cpu().numpy(), mask.cpu().numpy()
+        elif backend != 'opencv':
+            raise ValueError('unknown projection backend: {}'.format(backend))
+        lon_map, lat_map, mask = get_equirec_map(self.wFOV, self.THETA, self.PHI,
+                                                 self._height, self._width, height, width, rows)
+
+        persp = cv2.remap(self._img, lon_map, lat_map, cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
+        
+        # uint8 mask keeps persp uint8 instead of promoting the whole image to int64
+        mask = np.repeat(mask[:, :, np.newaxis], 3, axis=2)
+        persp = persp * mask
+        
         
-        x_map = np.cos(np.radians(x)) * np.cos(np.radians(y))
-        y_map = np.sin(np.radians(x)) * np.cos(np.radians(y))
-        z_map = np.sin(np.radians(y))
+        return persp , mask
 
-        xyz = np.stack((x_map,y_map,z_map),axis=2)
 
-        y_axis = np.array([0.0, 1.0, 0.0], np.float32)
-        z_axis = np.array([0.0, 0.0, 1.0], np.float32)
-        [R1, _] = cv2.Rodrigues(z_axis * np.radians(self.THETA))
-        [R2, _] = cv2.Rodrigues(np.dot(R1, y_axis) * np.radians(-self.PHI))
+def get_equirec_map(FOV, THETA, PHI, img_height, img_width, height, width, rows=None):
+    """
+    Remap table from an (img_height, img_width) perspective view to a (height, width) equirectangular
+    image. Returns float32 lon_map / lat_map for cv2.remap and the uint8 valid-pixel mask of the view.
+    The table only depends on the camera and the two image sizes, so it can be computed once and reused.
+    With rows=(start, stop) only that row window of the equirect is computed.
+    """
+    row_start, row_stop = (0, height) if rows is None else rows
 
-        R1 = np.linalg.inv(R1)
-        R2 = np.linalg.inv(R2)
+    x,y = np.meshgrid(np.linspace(-180, 180,width),np.linspace(90,-90,height)[row_start:row_stop])
+    
+    x_map = np.cos(np.radians(x)) * np.cos(np.radians(y))
+    y_map = np.sin(np.radians(x)) * np.cos(np.radians(y))
+    z_map = np.sin(np.radians(y))
 
-        xyz = xyz.reshape([height * width, 3]).T
-        xyz = np.dot(R2, xyz)
-        xyz = np.dot(R1, xyz).T
+    xyz = np.stack((x_map,y_map,z_map),axis=2)
+    return get_view_map(FOV, THETA, PHI, img_height, img_width, xyz)
 
-        xyz = xyz.reshape([height , width, 3])
-        inverse_mask = np.where(xyz[:,:,0]>0,1,0)
 
-        xyz[:,:] = xyz[:,:]/np.repeat(xyz[:,:,0][:, :, np.newaxis], 3, axis=2)
-        
-        
-        lon_map = np.where((-self.w_len<xyz[:,:,1])&(xyz[:,:,1]<self.w_len)&(-self.h_len<xyz[:,:,2])
-                    &(xyz[:,:,2]<self.h_len),(xyz[:,:,1]+self.w_len)/2/self.w_len*self._width,0)
-        lat_map = np.where((-self.w_len<xyz[:,:,1])&(xyz[:,:,1]<self.w_len)&(-self.h_len<xyz[:,:,2])
-                    &(xyz[:,:,2]<self.h_len),(-xyz[:,:,2]+self.h_len)/2/self.h_len*self._height,0)
-        mask = np.where((-self.w_len<xyz[:,:,1])&(xyz[:,:,1]<self.w_len)&(-self.h_len<xyz[:,:,2])
-                    &(xyz[:,:,2]<self.h_len),1,0)
-
-        persp = cv2.remap(self._img, lon_map.astype(np.float32), lat_map.astype(np.float32), cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
-        
-        mask = mask * inverse_mask
-        mask = np.repeat(mask[:, :, np.newaxis], 3, axis=2)
-        persp = persp * mask
-        
-        
-        return persp , mask
-        
+def view_rotation(THETA, PHI):
+    """(R1, R2) of a view: world direction = R2 @ R1 @ view direction (x forward, y right, z up)."""
+    y_axis = np.array([0.0, 1.0, 0.0], np.float32)
+    z_axis = np.array([0.0, 0.0, 1.0], np.float32)
+    [R1, _] = cv2.Rodrigues(z_axis * np.radians(THETA))
+    [R2, _] = cv2.Rodrigues(np.dot(R1, y_axis) * np.radians(-PHI))
+    return R1, R2
 
 
+def get_view_map(FOV, THETA, PHI, img_height, img_width, xyz):
+    """
+    Remap table from an (img_height, img_width) perspective view to arbitrary output pixels,
+    given as the (h, w, 3) world directions xyz of their rays. Same returns as get_equirec_map.
+    """
+    height, width = xyz.shape[:2]
+    hFOV = float(img_height) / img_width * FOV
+    w_len = np.tan(np.radians(FOV / 2.0))
+    h_len = np.tan(np.radians(hFOV / 2.0))
 
+    R1, R2 = view_rotation(THETA, PHI)
+    R1 = np.linalg.inv(R1)
+    R2 = np.linalg.inv(R2)
 
+    xyz = xyz.reshape([height * width, 3]).T
+    xyz = np.dot(R2, xyz)
+    xyz = np.dot(R1, xyz).T
 
+    xyz = xyz.reshape([height , width, 3])
+    inverse_mask = np.where(xyz[:,:,0]>0,1,0)
+
+    xyz[:,:] = xyz[:,:]/np.repeat(xyz[:,:,0][:, :, np.newaxis], 3, axis=2)
+    
+    valid = (-w_len<xyz[:,:,1])&(xyz[:,:,1]<w_len)&(-h_len<xyz[:,:,2])&(xyz[:,:,2]<h_len)
+    lon_map = np.where(valid,(xyz[:,:,1]+w_len)/2/w_len*img_width,0)
+    lat_map = np.where(valid,(-xyz[:,:,2]+h_len)/2/h_len*img_height,0)
+    mask = (valid & (inverse_mask > 0)).astype(np.uint8)
 
+    return lon_map.astype(np.float32), lat_map.astype(np.float32), mask
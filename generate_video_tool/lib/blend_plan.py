@@ -0,0 +1,286 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+import lib.remap_tables as remap_tables
+import lib.cubemap as cubemap
+
+# rows of wrap padding added above and below every view in the atlas, enough for the 4x4 cubic kernel
+_ATLAS_PAD = 2
+# rows projected at once while building a plan, bounds the temporary per-view tables
+_BUILD_ROWS = 32
+
+# output layouts a plan can be built for: an equirect, or the CUBE_FACES of a cubemap stacked
+# vertically into a (6 * face_size, face_size) image
+LAYOUTS = ('equirect', 'cubemap')
+
+# Process-wide LRU cache of blend plans, the cache of the per-view remap tables (see remap_tables.py).
+# key: (rig, view_h, view_w, out_h, out_w, row_start, row_stop), rig is a tuple of (FOV, THETA, PHI),
+# with the layout appended for layouts other than equirect. A plan of the 4096 wide pano is ~100 MB; the
+# app uses one fixed rig (its equirect and cubemap plans), MAX_PLANS leaves room for a few more.
+MAX_PLANS = 8
+_plans = OrderedDict()
+_lock = threading.Lock()
+
+
+def _store_plan(key, plan):
+    # caller holds _lock
+    plan = _plans.setdefault(key, plan)
+    _plans.move_to_end(key)
+    while len(_plans) > MAX_PLANS:
+        _plans.popitem(last=False)
+    return plan
+
+
+class BlendPlan:
+    """
+    Precomputed stitching of a fixed rig of perspective views into an equirectangular image.
+
+    Every equirect pixel is covered by at most a few views, so instead of projecting all views
+    over the full frame the plan keeps, for each output pixel, K contributor slots:
+        view_index: (K, h, W) int8, contributing view or -1 for an empty slot
+        map_xy:     (K*h, W, 2) int16, integer source position in the view atlas (cv2 fixed-point map)
+        map_frac:   (K*h, W) uint16, sub-pixel part of the source position (cv2 fixed-point map)
+        weight:     (K, h, W) float16, blend weight normalized over the slots of the pixel
+    The output is the (height, width) row window the plan was built for. Only its rows
+    [row_start, row_stop) that any view covers are stored, h = row_stop - row_start.
+    All views are packed into one atlas so a single cv2.remap gathers every slot.
+    """
+
+    def __init__(self, view_index, map_xy, map_frac, weight, row_start, height, width, view_h, view_w):
+        self.view_index = view_index
+        self.map_xy = map_xy
+        self.map_frac = map_frac
+        self.weight = weight
+        self.row_start = row_start
+        self.height = height
+        self.width = width
+        self.view_h = view_h
+        self.view_w = view_w
+
+    @property
+    def n_slots(self):
+        return self.weight.shape[0]
+
+    @property
+    def row_stop(self):
+        return self.row_start + self.weight.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.view_index.nbytes + self.map_xy.nbytes + self.map_frac.nbytes + self.weight.nbytes
+
+    def atlas(self, views):
+        """Stack the views vertically, each padded with wrapped rows like cv2.BORDER_WRAP would sample."""
+        n = len(views)
+        step = self.view_h + 2 * _ATLAS_PAD
+        atlas = np.empty((n * step, self.view_w, 3), np.uint8)
+        for i, view in enumerate(views):
+            atlas[i*step:(i+1)*step] = cv2.copyMakeBorder(
+                view, _ATLAS_PAD, _ATLAS_PAD, 0, 0, cv2.BORDER_WRAP)
+        return atlas
+
+    def apply(self, views):
+        """Blend the views (list of (view_h, view_w, 3) uint8) into a (height, width, 3) float32 image."""
+        atlas = self.atlas(views)
+        samples = cv2.remap(atlas, self.map_xy, self.map_frac, cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
+        samples = samples.reshape(self.n_slots, -1, self.width, 3)
+
+        out = np.full((self.height, self.width, 3), 255., np.float32)
+        band = out[self.row_start:self.row_stop]
+        band[:] = samples[0] * self.weight[0][..., None]
+        for k in range(1, self.n_slots):
+            band += samples[k] * self.weight[k][..., None]
+        band[self.view_index[0] < 0] = 255.
+        return out
+
+    def strip_rows(self, memory_budget):
+        """Rows per strip of iter_strips so that the strip buffers stay within memory_budget bytes."""
+        # per output row: uint8 slot samples, float16 weighted samples, float32 accumulator, uint8 result
+        row_bytes = self.width * 3 * (1 + 2 + 4 + 1)
+        return max(1, int(memory_budget) // row_bytes)
+
+    def iter_strips(self, views, strip_rows):
+        """
+        Blend the views strip by strip. Yields (row0, strip) in row order, strip is a (n, width, 3) uint8
+        view of rows [row0, row0 + n) of the image apply() returns (truncated to uint8 like astype).
+        The strip buffers are reused, consume or copy each strip before advancing the generator.
+        """
+        atlas = self.atlas(views)
+        h = self.row_stop - self.row_start
+        samples = np.empty((strip_rows, self.width, 3), np.uint8)
+        weighted = np.empty((strip_rows, self.width, 3), np.float16)
+        acc = np.empty((strip_rows, self.width, 3), np.float32)
+        out = np.empty((strip_rows, self.width, 3), np.uint8)
+        fill = np.full((strip_rows, self.width, 3), 255, np.uint8)
+
+        for r0 in range(0, self.row_start, strip_rows):
+            yield r0, fill[:min(strip_rows, self.row_start - r0)]
+        for r0 in range(0, h, strip_rows):
+            n = min(strip_rows, h - r0)
+            for k in range(self.n_slots):
+                rows = slice(k * h + r0, k * h + r0 + n)
+                cv2.remap(atlas, self.map_xy[rows], self.map_frac[rows], cv2.INTER_CUBIC,
+                          dst=samples[:n], borderMode=cv2.BORDER_WRAP)
+                # same arithmetic as apply(): float16 products summed in float32
+                np.multiply(samples[:n], self.weight[k, r0:r0+n, :, None], out=weighted[:n])
+                if k == 0:
+                    acc[:n] = weighted[:n]
+                else:
+                    acc[:n] += weighted[:n]
+            acc[:n][self.view_index[0, r0:r0+n] < 0] = 255.
+            out[:n] = acc[:n]
+            yield self.row_start + r0, out[:n]
+        for r0 in range(self.row_stop, self.height, strip_rows):
+            yield r0, fill[:min(strip_rows, self.height - r0)]
+
+    def to_arrays(self):
+        return {
+            'view_index': self.view_index,
+            'map_xy': self.map_xy,
+            'map_frac': self.map_frac,
+            'weight': self.weight,
+            'meta': np.array([self.row_start, self.height, self.width, self.view_h, self.view_w], np.int64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        row_start, height, width, view_h, view_w = arrays['meta'].tolist()
+        return cls(arrays['view_index'], arrays['map_xy'], arrays['map_frac'], arrays['weight'],
+                   row_start, height, width, view_h, view_w)
+
+
+def build_blend_plan(F_T_P_array, view_h, view_w, height, width, rows=None, layout='equirect'):
+    """
+    Build the BlendPlan of a rig from the per-view remap tables.
+    rows=(start, stop) restricts the plan to that row window of the (height, width) output,
+    the rows outside it are never projected. layout='cubemap' needs height == 6 * width.
+    The tables are computed _BUILD_ROWS rows at a time, so building needs little more memory than the plan.
+    """
+    step = view_h + 2 * _ATLAS_PAD
+    row_start, row_stop = (0, height) if rows is None else rows
+    out_height = row_stop - row_start
+
+    chunks = []
+    for r0 in range(row_start, row_stop, _BUILD_ROWS):
+        r1 = min(r0 + _BUILD_ROWS, row_stop)
+        # project the views once; the tables themselves are not cached
+        if layout == 'cubemap':
+            xyz = cubemap.cubemap_directions(width, (r0, r1))
+            tables = [remap_tables.build_view_table(F, T, P, view_h, view_w, xyz) for F, T, P in F_T_P_array]
+        else:
+            tables = [remap_tables.build_remap_table(F, T, P, view_h, view_w, height, width, (r0, r1))
+                      for F, T, P in F_T_P_array]
+        w_all = np.stack([t[2] for t in tables])                            # n, r, W
+        n_slots = max(int((w_all != 0).sum(axis=0).max()), 1)
+        order = np.argsort(w_all == 0, axis=0, kind='stable')[:n_slots]     # contributing views first
+        w_sel = np.take_along_axis(w_all, order, axis=0)
+        total = w_sel.sum(axis=0)
+        total[total == 0] = 1
+        used = w_sel != 0
+        lon_sel = np.take_along_axis(np.stack([t[0] for t in tables]), order, axis=0)
+        lat_sel = np.take_along_axis(np.stack([t[1] for t in tables]), order, axis=0) + order * step + _ATLAS_PAD
+        # convert to cv2 fixed-point maps per chunk, the float maps of the whole plan never exist at once
+        map_xy, map_frac = cv2.convertMaps(np.where(used, lon_sel, 0).astype(np.float32).reshape(-1, width),
+                                           np.where(used, lat_sel, 0).astype(np.float32).reshape(-1, width),
+                                           cv2.CV_16SC2)
+        chunks.append((np.where(used, order, -1).astype(np.int8),
+                       map_xy.reshape(n_slots, -1, width, 2), map_frac.reshape(n_slots, -1, width),
+                       (w_sel / total).astype(np.float16)))
+
+    # chunks may differ in slot count, pad to the largest and keep only the covered rows
+    n_slots = max(c[0].shape[0] for c in chunks)
+    covered_rows = np.nonzero(np.concatenate([(c[0][0] >= 0).any(axis=1) for c in chunks]))[0]
+    if len(covered_rows) == 0:
+        start, stop = 0, 0
+    else:
+        start, stop = int(covered_rows[0]), int(covered_rows[-1]) + 1
+    h = stop - start
+
+    view_index = np.full((n_slots, h, width), -1, np.int8)
+    map_xy = np.zeros((n_slots, h, width, 2), np.int16)
+    map_frac = np.zeros((n_slots, h, width), np.uint16)
+    weight = np.zeros((n_slots, h, width), np.float16)
+    r0 = 0
+    for chunk in chunks:
+        r1 = r0 + chunk[0].shape[1]
+        src = slice(max(start - r0, 0), min(stop, r1) - r0)
+        dst = slice(max(r0 - start, 0), max(min(stop, r1) - start, 0))
+        for array, value in zip((view_index, map_xy, map_frac, weight), chunk):
+            if src.start < src.stop:
+                array[:value.shape[0], dst] = value[:, src]
+        r0 = r1
+    chunks.clear()
+
+    return BlendPlan(view_index, map_xy.reshape(-1, width, 2), map_frac.reshape(-1, width), weight,
+                     start, out_height, width, view_h, view_w)
+
+
+def _plan_key(F_T_P_array, view_h, view_w, height, width, rows=None, layout='equirect'):
+    if layout not in LAYOUTS:
+        raise ValueError('unknown plan layout: {}'.format(layout))
+    if layout == 'cubemap' and height != 6 * width:
+        raise ValueError('cubemap plans are (6 * face_size, face_size), got ({}, {})'.format(height, width))
+    rig = tuple(tuple(float(v) for v in ftp) for ftp in F_T_P_array)
+    row_start, row_stop = (0, height) if rows is None else rows
+    key = (rig, int(view_h), int(view_w), int(height), int(width), int(row_start), int(row_stop))
+    return key if layout == 'equirect' else key + (layout,)
+
+
+def get_blend_plan(F_T_P_array, view_h, view_w, height, width, rows=None, layout='equirect'):
+    """Return the cached BlendPlan of a rig for the given row window, building it on first use."""
+    key = _plan_key(F_T_P_array, view_h, view_w, height, width, rows, layout)
+    with _lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+    plan = build_blend_plan(F_T_P_array, view_h, view_w, height, width, key[5:7], layout)
+    with _lock:
+        return _store_plan(key, plan)
+
+
+def has_blend_plan(F_T_P_array, view_h, view_w, height, width, rows=None, layout='equirect'):
+    return _plan_key(F_T_P_array, view_h, view_w, height, width, rows, layout) in _plans
+
+
+def clear_blend_plans():
+    with _lock:
+        _plans.clear()
+
+
+def save_blend_plans(path):
+    """Dump all cached plans to a single .npz file."""
+    with _lock:
+        items = list(_plans.items())
+    arrays = {}
+    for i, (key, plan) in enumerate(items):
+        arrays[f'rig_{i}'] = np.array(key[0], np.float64)
+        arrays[f'sizes_{i}'] = np.array(key[1:7], np.int64)
+        arrays[f'layout_{i}'] = np.array(key[7] if len(key) > 7 else 'equirect')
+        for name, value in plan.to_arrays().items():
+            arrays[f'{name}_{i}'] = value
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return len(items)
+
+
+def load_blend_plans(path):
+    """Load plans written by save_blend_plans into the process-wide cache. Returns the number loaded."""
+    n = 0
+    with np.load(path) as data:
+        while f'rig_{n}' in data:
+            plan = BlendPlan.from_arrays({name: data[f'{name}_{n}'] for name in
+                                          ('view_index', 'map_xy', 'map_frac', 'weight', 'meta')})
+            view_h, view_w, height, width, row_start, row_stop = data[f'sizes_{n}'].tolist()
+            # files written before cubemap plans existed have no layout entries
+            layout = str(data[f'layout_{n}']) if f'layout_{n}' in data else 'equirect'
+            key = _plan_key(data[f'rig_{n}'].tolist(), view_h, view_w, height, width, (row_start, row_stop), layout)
+            with _lock:
+                _plans.pop(key, None)
+                _store_plan(key, plan)
+            n += 1
+    return n
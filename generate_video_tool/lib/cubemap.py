@@ -0,0 +1,26 @@
+import numpy as np
+import lib.Perspec2Equirec as P2E
+
+# faces of a cubemap as (name, THETA, PHI) in degree: every face is the 90 degree square perspective
+# view at that angle, with the conventions of Perspec2Equirec (THETA=90 is right of front, PHI=90 up)
+CUBE_FACES = [('front', 0, 0), ('right', 90, 0), ('back', 180, 0),
+              ('left', 270, 0), ('up', 0, 90), ('down', 0, -90)]
+
+
+def cubemap_directions(face_size, rows=None):
+    """
+    World directions of the pixel rays of a cubemap whose CUBE_FACES are stacked vertically
+    into a (6 * face_size, face_size) image. rows=(start, stop) restricts to that row window.
+    Returns float64 (rows, face_size, 3).
+    """
+    row_start, row_stop = (0, 6 * face_size) if rows is None else rows
+    r = np.arange(row_start, row_stop)
+    # pixel centers on the z=1 image plane of the face, x forward, y right, z up
+    t = (np.arange(face_size) + 0.5) / face_size * 2 - 1
+    local = np.empty((len(r), face_size, 3))
+    local[..., 0] = 1
+    local[..., 1] = t[None, :]
+    local[..., 2] = -((r % face_size + 0.5) / face_size * 2 - 1)[:, None]
+
+    rotations = np.stack([np.dot(*P2E.view_rotation(THETA, PHI)[::-1]) for _, THETA, PHI in CUBE_FACES])
+    return np.einsum('rij,rwj->rwi', rotations[r // face_size], local)
@@ -0,0 +1,126 @@
+import os
+import threading
+import queue
+import time
+import numpy as np
+
+
+class PipelineStats:
+    def __init__(self, frames, seconds, render_seconds, encode_seconds, num_workers, queue_depth, chunk_size):
+        self.frames = frames
+        self.seconds = seconds                  # wall time of the whole run
+        self.render_seconds = render_seconds    # summed over the renderer threads
+        self.encode_seconds = encode_seconds    # time spent in the encoder stage
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.chunk_size = chunk_size
+
+    @property
+    def fps(self):
+        return self.frames / self.seconds if self.seconds > 0 else 0.
+
+    @property
+    def render_fps(self):
+        # frames/sec of a single renderer thread
+        return self.frames / self.render_seconds if self.render_seconds > 0 else 0.
+
+    @property
+    def encode_fps(self):
+        return self.frames / self.encode_seconds if self.encode_seconds > 0 else 0.
+
+    def __repr__(self):
+        return ('PipelineStats(frames={}, seconds={:.3f}, fps={:.1f}, render_fps={:.1f}, encode_fps={:.1f}, '
+                'num_workers={}, queue_depth={}, chunk_size={})').format(
+                    self.frames, self.seconds, self.fps, self.render_fps, self.encode_fps,
+                    self.num_workers, self.queue_depth, self.chunk_size)
+
+
+class FramePipeline:
+    """
+    Bounded producer/consumer pipeline for rendering and encoding a frame sequence.
+
+    A pool of renderer threads renders chunks of consecutive frames into preallocated chunk buffers,
+    a single encoder stage (the calling thread) writes the chunks in frame order. There are queue_depth
+    chunk buffers in total and a renderer needs a free one before it takes the next chunk, so at most
+    queue_depth chunks are in flight and memory stays bounded however fast the renderers are.
+    cv2 releases the GIL in remap, so threads scale with the available cores.
+    """
+
+    def __init__(self, num_workers=None, queue_depth=None, chunk_size=8):
+        self.num_workers = max(1, num_workers or os.cpu_count() or 1)
+        self.queue_depth = max(1, queue_depth or 2 * self.num_workers)
+        self.chunk_size = max(1, chunk_size)
+
+    def run(self, make_renderer, num_frames, frame_shape, write, dtype=np.uint8):
+        """
+        make_renderer() is called once per renderer thread and returns render(index, out), which renders
+        frame `index` into the preallocated `out` array of shape frame_shape.
+        write(frame) is called from the calling thread, once per frame, in frame order.
+        Returns PipelineStats.
+        """
+        start = time.perf_counter()
+        chunk_size = self.chunk_size
+        n_chunks = (num_frames + chunk_size - 1) // chunk_size
+        num_workers = min(self.num_workers, max(n_chunks, 1))
+
+        free = queue.Queue()
+        for _ in range(self.queue_depth):
+            free.put(np.empty((chunk_size,) + tuple(frame_shape), dtype))
+        ready = queue.Queue()
+        next_chunk = [0]
+        chunk_lock = threading.Lock()
+        render_seconds = [0.] * num_workers
+
+        def worker(worker_id):
+            try:
+                render = make_renderer()
+                while True:
+                    buf = free.get()
+                    if buf is None:
+                        return
+                    # chunks are handed out in order and only to a thread holding a buffer,
+                    # so the chunk the encoder waits for is always being rendered
+                    with chunk_lock:
+                        chunk = next_chunk[0]
+                        next_chunk[0] += 1
+                    if chunk >= n_chunks:
+                        free.put(buf)
+                        return
+                    t = time.perf_counter()
+                    first = chunk * chunk_size
+                    n = min(chunk_size, num_frames - first)
+                    for k in range(n):
+                        render(first + k, buf[k])
+                    render_seconds[worker_id] += time.perf_counter() - t
+                    ready.put((chunk, n, buf))
+            except BaseException as e:
+                ready.put((None, 0, e))
+
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True, name=f'frame-render-{i}')
+                   for i in range(num_workers)]
+        for thread in threads:
+            thread.start()
+
+        encode_seconds = 0.
+        pending = {}
+        try:
+            for chunk in range(n_chunks):
+                while chunk not in pending:
+                    c, n, buf = ready.get()
+                    if c is None:
+                        raise buf
+                    pending[c] = (n, buf)
+                n, buf = pending.pop(chunk)
+                t = time.perf_counter()
+                for k in range(n):
+                    write(buf[k])
+                encode_seconds += time.perf_counter() - t
+                free.put(buf)
+        finally:
+            for _ in threads:
+                free.put(None)
+            for thread in threads:
+                thread.join()
+
+        return PipelineStats(num_frames, time.perf_counter() - start, sum(render_seconds), encode_seconds,
+                             num_workers, self.queue_depth, chunk_size)
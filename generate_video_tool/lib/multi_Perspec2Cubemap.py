@@ -0,0 +1,47 @@
+import os
+import sys
+import cv2
+import numpy as np
+import lib.blend_plan as blend_plan
+from lib.cubemap import CUBE_FACES
+
+
+class Perspective:
+    def __init__(self, img_array , F_T_P_array ):
+
+        assert len(img_array)==len(F_T_P_array)
+
+        self.img_array = img_array
+        self.F_T_P_array = F_T_P_array
+
+    def _views(self):
+        return [cv2.imread(img, cv2.IMREAD_COLOR) if isinstance(img, str) else img for img in self.img_array]
+
+    def _plan(self, views, face_size):
+        return blend_plan.get_blend_plan(self.F_T_P_array, views[0].shape[0], views[0].shape[1],
+                                         6 * face_size, face_size, layout='cubemap')
+
+    def GetCubemap(self,face_size):
+        #
+        # the six CUBE_FACES sampled directly from the perspective views, no equirect in between.
+        # Returns float32 (6, face_size, face_size, 3), overlapping views are feathered like in the
+        # equirect stitcher and uncovered pixels are 255.
+        #
+        views = self._views()
+        return self._plan(views, face_size).apply(views).reshape(6, face_size, face_size, 3)
+
+    def GetCubemapStrips(self,face_size,memory_budget=64<<20):
+        #
+        # tiled GetCubemap: yields (face, row0, strip) with strip a uint8 (n, face_size, 3) block of rows
+        # [row0, row0 + n) of face CUBE_FACES[face]. Strips are reused buffers, consume them before the
+        # next one is produced.
+        #
+        views = self._views()
+        plan = self._plan(views, face_size)
+        for row0, strip in plan.iter_strips(views, min(plan.strip_rows(memory_budget), face_size)):
+            # strips never span more than two faces since they are at most face_size rows
+            while len(strip):
+                face, r = divmod(row0, face_size)
+                n = min(len(strip), face_size - r)
+                yield face, r, strip[:n]
+                row0, strip = row0 + n, strip[n:]
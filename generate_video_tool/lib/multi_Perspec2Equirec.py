@@ -2,41 +2,37 @@ import os
 import sys
 import cv2
 import numpy as np
-import lib.Perspec2Equirec as P2E
+import lib.blend_plan as blend_plan
 class Perspective:
     def __init__(self, img_array , F_T_P_array ):
-        
+
         assert len(img_array)==len(F_T_P_array)
-        
+
         self.img_array = img_array
         self.F_T_P_array = F_T_P_array
-    
-    def GetEquirec(self,height,width):
+
+    def GetEquirec(self,height,width,rows=None,backend='opencv',device=None):
         #
         # THETA is left/right angle, PHI is up/down angle, both in degree
+        # rows=(start, stop) renders only that row window of the (height, width) equirect
+        # backend='torch' stitches with one batched grid_sample on device (see lib.torch_projection)
         #
-        merge_image = np.zeros((height,width,3))
-        merge_mask = np.zeros((height,width,3))
-        for img_dir,[F,T,P] in zip (self.img_array,self.F_T_P_array):
-            per = P2E.Perspective(img_dir,F,T,P)        # Load equirectangular image
-            img , mask = per.GetEquirec(height,width)   # Specify parameters(FOV, theta, phi, height, width)
-            mask = mask.astype(np.float32)
-            img = img.astype(np.float32)
-            weight_mask = np.zeros((img_dir.shape[0],img_dir.shape[1], 3))
-            w = img_dir.shape[1]
-            weight_mask[:,0:w//2,:] = np.linspace(0,1,w//2)[...,None]
-            weight_mask[:,w//2:,:] = np.linspace(1,0,w//2)[...,None]
-            weight_mask = P2E.Perspective(weight_mask,F,T,P)
-            weight_mask, _ = weight_mask.GetEquirec(height,width)
-            blur = cv2.blur(mask,(5,5))
-            blur = blur * mask
-            mask = (blur == 1) * blur + (blur != 1) * blur * 0.05
-            merge_image += img * weight_mask
-            merge_mask += weight_mask
-        merge_image[merge_mask==0] = 255.
-        merge_mask = np.where(merge_mask==0,1,merge_mask)
-        merge_image = (np.divide(merge_image,merge_mask))
-        
-        return merge_image
-        
-        
+        # the blend plan of the rig is built once and cached, stitching is a single gather over all views
+        views = [cv2.imread(img, cv2.IMREAD_COLOR) if isinstance(img, str) else img for img in self.img_array]
+        if backend == 'torch':
+            import lib.torch_projection as torch_projection
+            return torch_projection.stitch_equirec(views, self.F_T_P_array, height, width, rows, device).cpu().numpy()
+        elif backend != 'opencv':
+            raise ValueError('unknown projection backend: {}'.format(backend))
+        plan = blend_plan.get_blend_plan(self.F_T_P_array, views[0].shape[0], views[0].shape[1], height, width, rows)
+        return plan.apply(views)
+
+    def GetEquirecStrips(self,height,width,rows=None,memory_budget=64<<20):
+        #
+        # tiled GetEquirec: yields (row0, strip) with strip a uint8 (n, width, 3) block of rows
+        # [row0, row0 + n) of the (rows window of the) equirect, blended under memory_budget bytes
+        # of strip buffers. Strips are reused buffers, consume them before the next one is produced.
+        #
+        views = [cv2.imread(img, cv2.IMREAD_COLOR) if isinstance(img, str) else img for img in self.img_array]
+        plan = blend_plan.get_blend_plan(self.F_T_P_array, views[0].shape[0], views[0].shape[1], height, width, rows)
+        return plan.iter_strips(views, plan.strip_rows(memory_budget))
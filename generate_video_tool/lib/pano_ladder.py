@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import cv2
+import lib.png_stream as png_stream
+
+
+def level_path(out_dir, width, full_width, name='pano'):
+    # the full resolution keeps the historical file name
+    return os.path.join(out_dir, f'{name}.png' if width == full_width else f'{name}_{width}.png')
+
+
+def level_sizes(full_width, full_height, widths):
+    """(width, height) of every ladder level, widths must divide full_width."""
+    sizes = []
+    for width in sorted(set(widths) | {full_width}):
+        if width <= 0 or full_width % width:
+            raise ValueError(f'pano ladder width {width} does not divide {full_width}')
+        factor = full_width // width
+        sizes.append((width, -(-full_height // factor)))
+    return sizes
+
+
+class _Downscaler:
+    # box filter by an integer factor over a stream of row strips; rows that do not fill a
+    # whole block are carried to the next strip, the last partial block is averaged on its own
+    def __init__(self, width, factor):
+        self.width = width
+        self.factor = factor
+        self._carry = None
+
+    def push(self, rows):
+        if self._carry is not None:
+            rows = np.concatenate([self._carry, rows])
+            self._carry = None
+        n = len(rows) // self.factor * self.factor
+        if n < len(rows):
+            self._carry = rows[n:].copy()
+        if n == 0:
+            return None
+        return cv2.resize(rows[:n], (self.width, n // self.factor), interpolation=cv2.INTER_AREA)
+
+    def flush(self):
+        if self._carry is None:
+            return None
+        rows, self._carry = self._carry, None
+        return cv2.resize(rows, (self.width, 1), interpolation=cv2.INTER_AREA)
+
+
+class LadderWriter:
+    """
+    Write a pano and its lower resolutions in one pass over its full-resolution row strips.
+    Every level is area-downscaled strip by strip and streamed to its own PNG, so neither the
+    full-size pano nor any level has to be held in memory. Levels are listed by `levels`
+    as (width, height, path), the full resolution is always one of them.
+    """
+
+    def __init__(self, out_dir, full_width, full_height, widths=(), name='pano'):
+        self.levels = [(w, h, level_path(out_dir, w, full_width, name))
+                       for w, h in level_sizes(full_width, full_height, widths)]
+        self._writers = []
+        try:
+            for width, height, path in self.levels:
+                self._writers.append((png_stream.PNGStreamWriter(path, width, height),
+                                      _Downscaler(width, full_width // width) if width != full_width else None))
+        except BaseException:
+            self.abort()
+            raise
+
+    def write(self, strip):
+        for writer, downscaler in self._writers:
+            rows = strip if downscaler is None else downscaler.push(strip)
+            if rows is not None:
+                writer.write(rows)
+
+    def close(self):
+        for writer, downscaler in self._writers:
+            rows = downscaler.flush() if downscaler is not None else None
+            if rows is not None:
+                writer.write(rows)
+            writer.close()
+
+    def abort(self):
+        for writer, _ in self._writers:
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
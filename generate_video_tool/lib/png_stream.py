@@ -0,0 +1,108 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types by channel count
+_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+# compressed bytes collected before an IDAT chunk is written
+_IDAT_SIZE = 1 << 16
+
+
+class PNGStreamWriter:
+    """
+    Write an 8-bit PNG row strip by row strip, so the full image never has to exist in memory.
+
+        with PNGStreamWriter(path, width, height) as png:
+            for strip in strips:       # (n, width, 3) uint8, BGR like cv2.imwrite
+                png.write(strip)
+
+    Rows are Sub-filtered and deflated incrementally. The file is written to path + '.tmp' and
+    moved into place once all `height` rows were written.
+    """
+
+    def __init__(self, path, width, height, channels=3, level=1, bgr=True):
+        if channels not in _COLOR_TYPES:
+            raise ValueError('unsupported channel count: {}'.format(channels))
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.bgr = bgr and channels >= 3
+        self.rows_written = 0
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        self._zlib = zlib.compressobj(level)
+        self._pending = []
+        self._pending_size = 0
+        self._file.write(_SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, _COLOR_TYPES[channels], 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(tag)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def _deflated(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= _IDAT_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self._pending:
+            self._chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def write(self, rows):
+        """Append (n, width, channels) uint8 rows (or (n, width) for one channel)."""
+        rows = np.asarray(rows, np.uint8).reshape(len(rows), self.width, self.channels)
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError('more than {} rows written'.format(self.height))
+        if self.bgr:
+            rows = rows[..., [2, 1, 0] + list(range(3, self.channels))]
+        rows = rows.reshape(len(rows), -1)
+        # filter type 1 (Sub): every byte minus the byte of the previous pixel, modulo 256
+        filtered = np.empty((len(rows), rows.shape[1] + 1), np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:self.channels + 1] = rows[:, :self.channels]
+        np.subtract(rows[:, self.channels:], rows[:, :-self.channels], out=filtered[:, self.channels + 1:])
+        self._deflated(self._zlib.compress(filtered.tobytes()))
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError('{} of {} rows written'.format(self.rows_written, self.height))
+            self._deflated(self._zlib.flush())
+            self._flush_idat()
+            self._chunk(b'IEND', b'')
+            self._file.close()
+            os.replace(self._tmp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+        self._file = None
+
+    def abort(self):
+        """Drop the partially written file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,33 @@
+import numpy as np
+import cv2
+import lib.Perspec2Equirec as P2E
+
+# Per-view remap tables for perspective -> equirectangular stitching, the inputs of a BlendPlan (they are
+# not cached themselves, blend_plan.py caches the plans built from them): (lon_map, lat_map, weight), where weight is the projected
+# feather ramp of the view, already multiplied by its valid mask.
+
+
+def _feather_weight(view_h, view_w):
+    # linear ramp 0 -> 1 -> 0 across the view width, used to blend overlapping views.
+    # kept in float64 so the projected weights match the original per-request stitching exactly
+    weight = np.zeros((view_h, view_w), np.float64)
+    weight[:, 0:view_w//2] = np.linspace(0, 1, view_w//2)
+    weight[:, view_w//2:] = np.linspace(1, 0, view_w - view_w//2)
+    return weight
+
+
+def build_remap_table(FOV, THETA, PHI, view_h, view_w, height, width, rows=None):
+    return _with_weight(P2E.get_equirec_map(FOV, THETA, PHI, view_h, view_w, height, width, rows), view_h, view_w)
+
+
+def build_view_table(FOV, THETA, PHI, view_h, view_w, xyz):
+    """Like build_remap_table, for output pixels given by the (h, w, 3) world directions of their rays."""
+    return _with_weight(P2E.get_view_map(FOV, THETA, PHI, view_h, view_w, xyz), view_h, view_w)
+
+
+def _with_weight(view_map, view_h, view_w):
+    lon_map, lat_map, mask = view_map
+    weight = cv2.remap(_feather_weight(view_h, view_w), lon_map, lat_map,
+                       cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
+    weight = weight * mask
+    return lon_map, lat_map, weight.astype(np.float32)
@@ -0,0 +1,147 @@
+import threading
+import numpy as np
+import cv2
+import torch
+import torch.nn.functional as F
+import lib.Perspec2Equirec as P2E
+import lib.Equirec2Perspec as E2P
+import lib.blend_plan as blend_plan
+
+# torch.nn.functional.grid_sample backend of the projection tools. Same geometry and bicubic kernel
+# (A=-0.75) as the OpenCV path, images are float tensors on any device and all views of a rig are
+# gathered by one batched grid_sample call.
+
+# rows / columns of circular padding, emulates cv2.BORDER_WRAP for the 4x4 kernel
+_PAD = 2
+
+# device copies of blend plans, key: (id(plan), n_views, device) -> (plan, grid, weight, empty)
+_plan_grids = {}
+_lock = threading.Lock()
+
+
+def to_nchw(images, device=None):
+    """(n, h, w, c) / (h, w, c) array, list of arrays or tensor -> float32 (n, c, h, w) tensor on device."""
+    if isinstance(images, (list, tuple)):
+        images = [torch.as_tensor(np.ascontiguousarray(img)) if not torch.is_tensor(img) else img for img in images]
+        images = torch.stack([img.to(device) for img in images])
+    elif not torch.is_tensor(images):
+        images = torch.as_tensor(np.ascontiguousarray(images))
+    images = images.to(device)
+    if images.dim() == 3:
+        images = images[None]
+    return images.permute(0, 3, 1, 2).float()
+
+
+def _normalize(x, size):
+    # pixel coordinate -> grid_sample coordinate for align_corners=True
+    return x / (size - 1) * 2 - 1
+
+
+def _wrap_pad(images, rows=True):
+    images = torch.cat([images[..., -_PAD:], images, images[..., :_PAD]], dim=-1)
+    if rows:
+        images = torch.cat([images[..., -_PAD:, :], images, images[..., :_PAD, :]], dim=-2)
+    return images
+
+
+def _remap(images, map_x, map_y, padded=None):
+    """
+    Bicubic remap of (n, c, h, w) images with float pixel maps of shape (n, H, W), wrapping horizontally
+    like cv2.remap(..., cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP). Returns (n, c, H, W), clamped to [0, 255].
+    padded may pass the already wrap-padded images (possibly expanded along n) to avoid padding again.
+    """
+    h, w = images.shape[-2:]
+    if padded is None:
+        padded = _wrap_pad(images)
+    grid = torch.stack([_normalize(map_x + _PAD, w + 2 * _PAD), _normalize(map_y + _PAD, h + 2 * _PAD)], dim=-1)
+    out = F.grid_sample(padded, grid, mode='bicubic', padding_mode='border', align_corners=True)
+    return out.clamp_(0, 255)
+
+
+def _plan_grid(plan, n_views, device):
+    key = (id(plan), n_views, str(device))
+    entry = _plan_grids.get(key)
+    if entry is None or entry[0] is not plan:
+        step = plan.view_h + 2 * blend_plan._ATLAS_PAD
+        map_x, map_y = cv2.convertMaps(plan.map_xy, plan.map_frac, cv2.CV_32FC1)
+        grid = torch.stack([
+            _normalize(torch.from_numpy(map_x) + _PAD, plan.view_w + 2 * _PAD),
+            _normalize(torch.from_numpy(map_y), n_views * step)], dim=-1)[None].to(device)
+        weight = torch.from_numpy(plan.weight.astype(np.float32)).to(device)
+        empty = torch.from_numpy(plan.view_index[0] < 0).to(device)
+        entry = (plan, grid, weight, empty)
+        with _lock:
+            _plan_grids[key] = entry
+    return entry[1:]
+
+
+def stitch_equirec(views, F_T_P_array, height, width, rows=None, device=None):
+    """
+    Stitch perspective views into a (height, width, 3) equirect (or its rows=(start, stop) window) with one
+    batched grid_sample. views: (n, h, w, 3) tensor / array or list of (h, w, 3) arrays. Returns a float32
+    (h_out, width, 3) tensor on device, uncovered pixels are 255 like the OpenCV stitcher.
+    """
+    views = to_nchw(views, device)
+    n, c, view_h, view_w = views.shape
+    device = views.device
+    plan = blend_plan.get_blend_plan(F_T_P_array, view_h, view_w, height, width, rows)
+    grid, weight, empty = _plan_grid(plan, n, device)
+
+    # same atlas as BlendPlan.atlas: views stacked vertically, each with wrapped rows above and below
+    pad = blend_plan._ATLAS_PAD
+    atlas = torch.cat([views[..., -pad:, :], views, views[..., :pad, :]], dim=-2)
+    atlas = atlas.permute(1, 0, 2, 3).reshape(1, c, -1, view_w)
+    samples = F.grid_sample(_wrap_pad(atlas, rows=False), grid, mode='bicubic', padding_mode='border', align_corners=True)
+    samples = samples.clamp_(0, 255).reshape(c, plan.n_slots, -1, width)
+
+    out = torch.full((c, plan.height, width), 255., device=device)
+    band = (samples * weight).sum(dim=1)
+    band.masked_fill_(empty, 255.)
+    out[:, plan.row_start:plan.row_stop] = band
+    return out.permute(1, 2, 0)
+
+
+def equirec_from_view(view, FOV, THETA, PHI, height, width, rows=None, device=None):
+    """Torch counterpart of Perspec2Equirec.Perspective.GetEquirec, returns (persp, mask) (h, w, 3) tensors."""
+    view = to_nchw(view, device)
+    lon_map, lat_map, mask = P2E.get_equirec_map(FOV, THETA, PHI, view.shape[-2], view.shape[-1],
+                                                 height, width, rows)
+    mask = torch.from_numpy(mask).to(view.device, torch.float32)[None]
+    persp = _remap(view, torch.from_numpy(lon_map).to(view.device)[None],
+                   torch.from_numpy(lat_map).to(view.device)[None])[0]
+    return (persp * mask).permute(1, 2, 0), mask.expand(3, -1, -1).permute(1, 2, 0)
+
+
+class TorchYawSweep:
+    """
+    Torch counterpart of Equirec2Perspec.YawSweep: renders perspective frames of one Equirectangular
+    (its map conventions, row band included, are reused) for batches of yaw angles. The equirect is
+    uploaded and padded once, the base map is computed once at THETA=0 and yaw only shifts the longitude.
+    """
+    def __init__(self, equ, FOV, height, width, PHI=0, device=None):
+        img = to_nchw(equ._img, device)
+        self.device = img.device
+        self._h, self._w = img.shape[-2:]
+        self._padded = _wrap_pad(img)
+        lon, lat = E2P._perspective_lonlat(FOV, 0, PHI, height, width)
+        self._lon = torch.from_numpy(lon).to(self.device, torch.float32)
+        self._lat = torch.from_numpy(equ._lat_to_y(lat)).to(self.device)
+        self._equ_cx = (equ._width - 1) / 2.0
+
+    def render(self, THETAs):
+        """THETAs: sequence of degrees. Returns (N, height, width, 3) float32 tensor in [0, 255]."""
+        THETAs = torch.as_tensor(THETAs, dtype=torch.float32, device=self.device)
+        # yawing after pitching: R2 @ R1 == R1 @ pitch, so the longitude shift holds for any PHI
+        lon = torch.remainder(self._lon[None] + THETAs[:, None, None] + 180, 360) - 180
+        map_x = lon / 180 * self._equ_cx + self._equ_cx
+        map_y = self._lat[None].expand_as(map_x)
+        grid = torch.stack([_normalize(map_x + _PAD, self._w + 2 * _PAD),
+                            _normalize(map_y + _PAD, self._h + 2 * _PAD)], dim=-1)
+        out = F.grid_sample(self._padded.expand(len(THETAs), -1, -1, -1), grid,
+                            mode='bicubic', padding_mode='border', align_corners=True)
+        return out.clamp_(0, 255).permute(0, 2, 3, 1)
+
+
+def render_perspectives(equ, FOV, THETAs, PHI, height, width, device=None):
+    """Torch counterpart of Equirec2Perspec.Equirectangular.GetPerspective for a batch of yaw angles."""
+    return TorchYawSweep(equ, FOV, height, width, PHI, device).render(THETAs)
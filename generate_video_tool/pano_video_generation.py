@@ -5,35 +5,137 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import lib.Equirec2Perspec as E2P
 import lib.multi_Perspec2Equirec as m_P2E
+import lib.multi_Perspec2Cubemap as m_P2C
+import lib.blend_plan as blend_plan
+import lib.frame_pipeline as frame_pipeline
+import lib.pano_ladder as pano_ladder
+import lib.png_stream as png_stream
+from lib.cubemap import CUBE_FACES
+import logging
+import time
 import uuid
 from PIL import Image
 from tqdm import tqdm
 
+# camera rig of the 8 generated views: (FOV, THETA, PHI) in degree
+PANO_RIG = [[90, 0, 0], [90, 45, 0], [90, 90, 0], [90, 135, 0],
+            [90, 180, 0], [90, 225, 0], [90, 270, 0], [90, 315, 0]]
+PANO_HEIGHT, PANO_WIDTH = 2048, 4096
+# rows of the equirect kept in pano.png, the rest is never covered by the rig
+PANO_ROWS = (540, PANO_HEIGHT - 540)
+# cubemap faces matching the 90 degrees per 1024 px of the 4096 wide pano
+CUBE_FACE_SIZE = 1024
 
+logger = logging.getLogger(__name__)
 
-def generate_video(image_paths, out_dir, gen_video=True):
-    pers = [cv2.imread(image_path) for image_path in image_paths]
 
-    ee = m_P2E.Perspective(pers,
-                            [[90, 0, 0], [90, 45, 0], [90, 90, 0], [90, 135, 0],
-                             [90, 180, 0], [90, 225, 0], [90, 270, 0], [90, 315, 0]]
-                            )
+def preload_blend_plans(cache_path=None, view_size=512, cube_face_size=None):
+    """
+    Warm the blend plan of PANO_RIG, and its cubemap plan when cube_face_size is given. Plans found in
+    cache_path are loaded from it, missing ones are built and, when cache_path is given, written back.
+    """
+    if cache_path and os.path.isfile(cache_path):
+        blend_plan.load_blend_plans(cache_path)
+    plans = [(PANO_HEIGHT, PANO_WIDTH, PANO_ROWS, 'equirect')]
+    if cube_face_size:
+        plans.append((6 * cube_face_size, cube_face_size, None, 'cubemap'))
+    built = False
+    for height, width, rows, layout in plans:
+        if not blend_plan.has_blend_plan(PANO_RIG, view_size, view_size, height, width, rows, layout):
+            blend_plan.get_blend_plan(PANO_RIG, view_size, view_size, height, width, rows, layout)
+            built = True
+    if cache_path and built:
+        blend_plan.save_blend_plans(cache_path)
 
-    new_pano = ee.GetEquirec(2048, 4096)
-    cv2.imwrite(os.path.join(out_dir, 'pano.png'), new_pano.astype(np.uint8)[540:-540])
+
+def _render_video_torch(equ, fov, video_size, interval_deg, num_frames, write, device, batch_size=32):
+    # the device renders batch_size frames per grid_sample call, encoding stays on the calling thread
+    import torch
+    import lib.torch_projection as torch_projection
+    start = time.perf_counter()
+    render_seconds = 0.
+    sweep = torch_projection.TorchYawSweep(equ, fov, video_size[0], video_size[1], device=device)
+    for first in range(0, num_frames, batch_size):
+        t = time.perf_counter()
+        thetas = [i * interval_deg for i in range(first, min(first + batch_size, num_frames))]
+        frames = sweep.render(thetas).to(torch.uint8).cpu().numpy()
+        render_seconds += time.perf_counter() - t
+        for frame in frames:
+            write(frame)
+    seconds = time.perf_counter() - start
+    return frame_pipeline.PipelineStats(num_frames, seconds, render_seconds, seconds - render_seconds,
+                                        1, 1, batch_size)
+
+
+def pano_levels(out_dir, ladder=()):
+    """(width, height, path) of every pano level generate_video writes for the given ladder widths."""
+    return [(w, h, pano_ladder.level_path(out_dir, w, PANO_WIDTH))
+            for w, h in pano_ladder.level_sizes(PANO_WIDTH, PANO_ROWS[1] - PANO_ROWS[0], ladder)]
+
+
+def cubemap_paths(out_dir):
+    """Paths of the faces generate_cubemap writes, in CUBE_FACES order."""
+    return [os.path.join(out_dir, f'cube_{name}.png') for name, _, _ in CUBE_FACES]
+
+
+def generate_cubemap(image_paths, out_dir, face_size=CUBE_FACE_SIZE, memory_budget=None):
+    # the six faces are sampled directly from the 8 views (lib.multi_Perspec2Cubemap), no equirect in between
+    # memory_budget (bytes) blends in strips streamed to the face PNGs
+    pers = [cv2.imread(image_path) if isinstance(image_path, str) else image_path for image_path in image_paths]
+    cc = m_P2C.Perspective(pers, PANO_RIG)
+    paths = cubemap_paths(out_dir)
+    if not memory_budget:
+        for path, face in zip(paths, cc.GetCubemap(face_size)):
+            cv2.imwrite(path, face.astype(np.uint8))
+        return paths
+    writers = [png_stream.PNGStreamWriter(path, face_size, face_size) for path in paths]
+    try:
+        for face, _, strip in cc.GetCubemapStrips(face_size, memory_budget):
+            writers[face].write(strip)
+        for writer in writers:
+            writer.close()
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    return paths
+
+
+def generate_video(image_paths, out_dir, gen_video=True, num_workers=None, queue_depth=None,
+                   backend='opencv', device=None, memory_budget=None, ladder=()):
+    # image_paths: image files or BGR uint8 arrays of the 8 views
+    # num_workers / queue_depth configure the video frame pipeline, see lib.frame_pipeline.FramePipeline
+    # backend='torch' stitches and renders with grid_sample on device, see lib.torch_projection
+    # memory_budget (bytes) stitches the opencv backend in strips streamed to pano.png
+    # ladder: extra pano widths (dividing PANO_WIDTH) written as pano_<width>.png, see pano_levels
+    pers = [cv2.imread(image_path) if isinstance(image_path, str) else image_path for image_path in image_paths]
+
+    ee = m_P2E.Perspective(pers, PANO_RIG)
+
+    pano_h = PANO_ROWS[1] - PANO_ROWS[0]
+    if memory_budget and backend == 'opencv':
+        strips = ee.GetEquirecStrips(PANO_HEIGHT, PANO_WIDTH, PANO_ROWS, memory_budget)
+        # only the uint8 band is kept, and only when the video needs it
+        new_pano = np.empty((pano_h, PANO_WIDTH, 3), np.uint8) if gen_video else None
+    else:
+        new_pano = ee.GetEquirec(PANO_HEIGHT, PANO_WIDTH, PANO_ROWS, backend=backend, device=device)
+        new_pano = new_pano.astype(np.uint8)
+        strips = [(0, new_pano)]
+    # every ladder level is downscaled from the blended strips, the pano is blended once
+    with pano_ladder.LadderWriter(out_dir, PANO_WIDTH, pano_h, ladder) as writer:
+        for row0, strip in strips:
+            writer.write(strip)
+            if new_pano is not None and strip is not new_pano:
+                new_pano[row0:row0 + len(strip)] = strip
     if not gen_video:
         return
-    equ = E2P.Equirectangular(new_pano)
+    # frames are rendered from the same uint8 pano that is written to pano.png
+    equ = E2P.Equirectangular(new_pano, full_height=PANO_HEIGHT, row_offset=PANO_ROWS[0])
     fov = 60
     video_size = (450, 600)
-    
-    img = equ.GetPerspective(fov, 0, 0, video_size[0], video_size[1])  # Specify parameters(FOV, theta, phi, height, width)
 
-    h = img.shape[0]
     margin = 0
-    if margin > 0:
-        img = img[margin:-margin]
-    size = (img.shape[1], img.shape[0])
+    size = (video_size[1], video_size[0] - 2 * margin)
 
     tmp_video_path = '/tmp/' + str(uuid.uuid4()) + '.mp4'
     save_video_path = os.path.join(out_dir, 'video.mp4')
@@ -41,15 +143,28 @@ def generate_video(image_paths, out_dir, gen_video=True):
 
     interval_deg = 0.5
     num_frames = int(360 / interval_deg)
-    for i in range(num_frames):
-        deg = i * interval_deg
-        img = equ.GetPerspective(fov, deg, 0, video_size[0], video_size[1])  # Specify parameters(FOV, theta, phi, height, width)
-        h = img.shape[0]
-        if margin > 0:
-            img = img[margin:-margin]
-        img = np.clip(img, 0, 255).astype(np.uint8)
-        out.write(img)
-    out.release()
+
+    def write(img):
+        out.write(img[margin:-margin] if margin > 0 else img)
+
+    try:
+        if backend == 'torch':
+            stats = _render_video_torch(equ, fov, video_size, interval_deg, num_frames, write, device)
+        else:
+            sweep = E2P.YawSweep(equ, fov, video_size[0], video_size[1])  # Specify parameters(FOV, height, width)
+
+            def make_renderer():
+                lon_buf, _ = sweep.new_buffers()
+                def render(i, img):
+                    sweep.render(i * interval_deg, out=img, lon_buf=lon_buf)
+                return render
+
+            pipeline = frame_pipeline.FramePipeline(num_workers=num_workers, queue_depth=queue_depth)
+            stats = pipeline.run(make_renderer, num_frames, (video_size[0], video_size[1], 3), write)
+    finally:
+        out.release()
+    logger.info('video.mp4: %s', stats)
+    return stats
    # os.system(f"ffmpeg -y -i {tmp_video_path} -vcodec libx264 {save_video_path}")
 
 if __name__ == '__main__':
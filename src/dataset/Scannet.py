@@ -30,7 +30,10 @@ class Scannetdataset(torch.utils.data.Dataset):
             if config['data_load_mode']=='fix_interval':
                 max_id=max(valid_id)
                 kf_ids=[i for i in range(0, max_id, config['test_interval']) if i in valid_id]
-                if len(kf_ids)>150: # relex this number if using GPU with large memory
+                # without neighbor selection (model.neighbor_top_k) the depth model's memory grows with the
+                # square of the number of keyframes, max_keyframes skips longer scenes (null: no limit)
+                max_keyframes=config.get('max_keyframes', 150)
+                if max_keyframes is not None and len(kf_ids)>max_keyframes:
                     continue
             else:
                 kf_path = os.path.join(scene_dir, 'key_frame_0.6.txt')
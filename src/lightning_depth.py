@@ -8,6 +8,7 @@ import numpy as np
 from einops import rearrange
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from .models.depth.MVDepthModel import MultiViewBaseModel
+from .models.modules.transformer import inference_mode
 import cv2
 
 
@@ -167,15 +168,20 @@ class DepthGenerator(pl.LightningModule):
             raise NotImplementedError
         latents = torch.cat([latents]*2)
         timestep = torch.cat([timestep]*2)
-        poses=torch.cat([batch['poses']]*2)
-        K=torch.cat([batch['K']]*2)
-        depths=torch.cat([batch['depths']]*2)
-        meta['poses']=poses
-        meta['K']=K
-        meta['depths']=depths
+        # both halves share the views: geometry is computed once and broadcast
+        meta['poses']=batch['poses']
+        meta['K']=batch['K']
+        meta['depths']=batch['depths']
+        meta['geometry_groups']=2
+        if 'geometry' in batch:
+            meta['geometry']=batch['geometry']
 
         return latents, timestep, prompt_embd, meta
 
+    def get_geometry(self, batch):
+        # poses, K and depths are fixed while sampling: the CPAttn geometry is computed once per run
+        return self.mv_base_model.get_geometry(batch['poses'], batch['K'], batch['depths'])
+
     @torch.no_grad()
     def forward_cls_free(self, latents, _timestep, prompt_embd, batch, model, type):
         _latents, _timestep, _prompt_embd, meta = self.gen_cls_free_guide_pair(
@@ -202,6 +208,7 @@ class DepthGenerator(pl.LightningModule):
             self.save_image(images_pred, images, batch['prompt'][0], batch['depth_inv_norm'].cpu().numpy(), batch_idx)
 
     @torch.no_grad()
+    @inference_mode
     def inference_inp(self, batch):
         
         images = batch['images']
@@ -227,6 +234,8 @@ class DepthGenerator(pl.LightningModule):
        
         self.scheduler.set_timesteps(self.diff_timestep, device=device)
         timesteps = self.scheduler.timesteps
+        # shallow copy: the per-run geometry and condition latents stay out of the caller's batch
+        batch = dict(batch, geometry=self.get_geometry(batch))
 
         for i, t in enumerate(timesteps):
             batch['images_condition']=images_latent
@@ -241,6 +250,7 @@ class DepthGenerator(pl.LightningModule):
         return images_pred
 
     @torch.no_grad()
+    @inference_mode
     def inference_gen(self, batch):
         images = batch['images']
         
@@ -266,6 +276,8 @@ class DepthGenerator(pl.LightningModule):
 
         self.scheduler.set_timesteps(self.diff_timestep, device=device)
         timesteps = self.scheduler.timesteps
+        # shallow copy: the per-run geometry and condition latents stay out of the caller's batch
+        batch = dict(batch, geometry=self.get_geometry(batch))
 
         for i, t in enumerate(timesteps):
             _timestep = torch.cat([t[None, None]]*m, dim=1)
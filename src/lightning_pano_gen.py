@@ -7,6 +7,7 @@ from transformers import CLIPTextModel, CLIPTokenizer
 import numpy as np
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from .models.pano.MVGenModel import MultiViewBaseModel
+from .models.modules.transformer import inference_mode
 
 
 class PanoGenerator(pl.LightningModule):
@@ -135,12 +136,11 @@ class PanoGenerator(pl.LightningModule):
         latents = torch.cat([latents]*2)
         timestep = torch.cat([timestep]*2)
         
-        R = torch.cat([batch['R']]*2)
-        K = torch.cat([batch['K']]*2)
-      
+        # both halves share the views: geometry is computed once for R / K and broadcast
         meta = {
-            'K': K,
-            'R': R,
+            'K': batch['K'],
+            'R': batch['R'],
+            'geometry_groups': 2,
         }
 
         return latents, timestep, prompt_embd, meta
@@ -170,6 +170,7 @@ class PanoGenerator(pl.LightningModule):
             self.save_image(images_pred, images, batch['prompt'], batch_idx)
 
     @torch.no_grad()
+    @inference_mode
     def inference(self, batch):
         images = batch['images']
         bs, m, h, w, _ = images.shape
@@ -7,6 +7,7 @@ from transformers import CLIPTextModel, CLIPTokenizer
 import numpy as np
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from .models.pano.MVGenModel import MultiViewBaseModel
+from .models.modules.transformer import inference_mode
 from einops import rearrange
 
 
@@ -153,12 +154,11 @@ class PanoOutpaintGenerator(pl.LightningModule):
         latents = torch.cat([latents]*2)
         timestep = torch.cat([timestep]*2)
         
-        R = torch.cat([batch['R']]*2)
-        K = torch.cat([batch['K']]*2)
-      
+        # both halves share the views: geometry is computed once for R / K and broadcast
         meta = {
-            'K': K,
-            'R': R
+            'K': batch['K'],
+            'R': batch['R'],
+            'geometry_groups': 2,
         }
 
         return latents, timestep, prompt_embd, meta
@@ -209,6 +209,7 @@ class PanoOutpaintGenerator(pl.LightningModule):
         return mask_latnets, masked_image_latents
 
     @torch.no_grad()
+    @inference_mode
     def inference(self, batch):
         images = batch['images']
         
@@ -1,13 +1,16 @@
 import torch
 import torch.nn as nn
 from .modules import CPBlock, ImageEncodingBlock
-from .utils import get_correspondence
+from .utils import cached_geometry
 from einops import rearrange
 
 class MultiViewBaseModel(nn.Module):
     def __init__(self, unet, config):
         super().__init__()
         self.overlap_filter=config['overlap_filter']
+        # neighbor selection for long sequences: top-k overlapping views within a temporal window (None: all)
+        self.neighbor_top_k=config.get('neighbor_top_k')
+        self.neighbor_window=config.get('neighbor_window')
         self.unet = unet
 
         self.trainable_parameters = []
@@ -58,40 +61,18 @@ class MultiViewBaseModel(nn.Module):
                                     list(self.condition_downblocks.parameters())+
                                     list(self.condition_upblocks.parameters()), 1.0)]
 
+    def get_geometry(self, poses, K, depths):
+        """DepthGeometry of the views; poses, K and depths are fixed while sampling, so it can be reused across steps."""
+        return cached_geometry(poses, K, depths, self.overlap_filter, self.neighbor_top_k, self.neighbor_window)
+
     def get_correspondence(self, cp_package):
-        
-        poses = cp_package['poses']
-        K = cp_package['K']
-        depths = cp_package['depths']
-        b, m, h, w = depths.shape
-
-        correspondence = torch.zeros(b, m, m, h, w, 2, device=depths.device)
-        K = K[:, None].repeat(1, m, 1, 1)
-        K = rearrange(K, 'b m h w -> (b m) h w')
-        overlap_ratios=torch.zeros(b, m, m, device=depths.device)
-        
-        for i in range(m):
-            pose_i = poses[:, i:i+1].repeat(1, m, 1, 1)
-            depth_i = depths[:, i:i+1].repeat(1, m, 1, 1)
-            pose_j = poses
-            depth_i = rearrange(depth_i, 'b m h w -> (b m) h w')
-            pose_j = rearrange(pose_j, 'b m h w -> (b m) h w')
-            pose_i = rearrange(pose_i, 'b m h w -> (b m) h w')
-            pose_rel = torch.inverse(pose_j)@pose_i
-            point_ij, _ = get_correspondence(
-                depth_i, pose_rel, K, None)  # bs, 2, hw
-            point_ij = rearrange(point_ij, '(b m) h w c -> b m h w c', b=b)
-            correspondence[:, i] = point_ij
-            mask=(point_ij[:,:,:,:,0]>=0)&(point_ij[:,:,:,:,0]<w)&(point_ij[:,:,:,:,1]>=0)&(point_ij[:,:,:,:,1]<h)
-            mask=rearrange(mask, 'b m h w -> b m (h w)')
-            overlap_ratios[:,i]=mask.float().mean(dim=-1)
-        for b_i in range(b):
-            for i in range(m):
-                for j in range(i+1,m):
-                    overlap_ratios[b_i, i, j] = overlap_ratios[b_i, j, i]=min(overlap_ratios[b_i, i, j], overlap_ratios[b_i, j, i])
-        overlap_mask=overlap_ratios>self.overlap_filter # filter image pairs that have too small overlaps
-        cp_package['correspondence'] = correspondence
-        cp_package['overlap_mask']=overlap_mask
+        # reuse the geometry of the sampling run if the caller passes it in
+        geometry = cp_package.get('geometry')
+        if geometry is None:
+            geometry = self.get_geometry(cp_package['poses'], cp_package['K'], cp_package['depths'])
+        cp_package['geometry'] = geometry
+        cp_package['correspondence'] = geometry.correspondence
+        cp_package['overlap_mask'] = geometry.overlap_mask
 
 
 
@@ -103,7 +84,8 @@ class MultiViewBaseModel(nn.Module):
         else:
             condition_flag=False
 
-        # compute correspondence
+        # compute correspondence; with meta['geometry_groups'] = g the batch is g copies of the views of
+        # poses / K / depths (classifier-free guidance pairs) that share one geometry
         self.get_correspondence(meta)
 
         hidden_states=latents_lr
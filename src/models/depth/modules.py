@@ -1,9 +1,9 @@
 import torch
 import torch.nn as nn
-from einops import rearrange
+import torch.nn.functional as F
+from einops import rearrange, repeat
 from ..modules.resnet import BasicResNetBlock
 from ..modules.transformer import BasicTransformerBlock, PosEmbedding
-from .utils import get_query_value
 
 
 class ImageEncodingBlock(nn.Module):
@@ -60,71 +60,33 @@ class CPAttn(nn.Module):
         x = rearrange(x, '(b m) c h w -> b m c h w', m=m)
         b=x.shape[0]
         img_h, img_w = reso
-        outs = []
-
-        poses = cp_package['poses']
-        K = cp_package['K']
-        depths = cp_package['depths']
-        correspondence = cp_package['correspondence']
-        overlap_mask=cp_package['overlap_mask']
-       
-        for b_i in range(b):
-            _outs=[]
-            for i in range(m):
-                
-                indexs = [j for j in range(m) if overlap_mask[b_i, i, j] and i!=j]
-                if len(indexs)==0: # if the image does not have overlap with others, use the nearby images
-                    if i==0:
-                        indexs=[1]
-                    elif i==m-1:
-                        indexs=[m-2]
-                    else:
-                        indexs=[i-1, i+1]
-
-                xy_l = []
-                xy_r = []
-                x_right = []
-                
-                xy_l = correspondence[b_i:b_i+1, i, indexs]
-                xy_r = correspondence[b_i:b_i+1, indexs, i]
-                    
-                x_left = x[b_i:b_i+1, i]
-                x_right = x[b_i:b_i+1, indexs]  # bs, l, h, w, c
-                pose_l = poses[b_i:b_i+1, i]
-                pose_r = poses[b_i:b_i+1, indexs]
-                
-                pose_rel = torch.inverse(pose_l)[:, None]@pose_r
-                _depths=depths[b_i:b_i+1, indexs]
-                depth_query=depths[b_i:b_i+1, i]
-                _K=K[b_i:b_i+1]
-                
-                query, key_value, key_value_xy, mask = get_query_value(
-                    x_left, x_right, xy_l, xy_r, depth_query, _depths, pose_rel, _K, img_h, img_w, img_h, img_w)
-              
-
-                key_value_xy = rearrange(key_value_xy, 'b l h w c->(b h w) l c')
-                key_value_pe = self.pe(key_value_xy)
-               
-
-                query = rearrange(query, 'b c h w->(b h w) c')[:, None]
-
-                key_value = rearrange(
-                    key_value, 'b l c h w-> (b h w) l c')
-                mask = rearrange(mask, 'b l h w -> (b h w) l')
-
-                key_value = (key_value + key_value_pe)*mask[..., None]
-                query_pe = self.pe(torch.zeros(
-                    query.shape[0], 1, 1, device=query.device))
-    
-                out = self.transformer(query, key_value, query_pe)
-
-                out = rearrange(out[:, 0], '(b h w) c -> b c h w', h=h, w=w)
-                _outs.append(out)
-            _outs=torch.cat(_outs)
-            outs.append(_outs)
-            
-                
-        out = torch.stack(outs)
-        out=rearrange(out, 'b m c h w -> (b m) c h w')
+
+        # neighbors, sample grids and depth checks of this feature level, shared by all denoising steps
+        geometry = cp_package['geometry']
+        level = geometry.level(img_h, img_w, h, w)
+
+        # shared geometry across batch groups (see MultiViewBaseModel.forward): the geometry is that of one
+        # group, the groups are sampled as extra channels and the embeddings / masks broadcast over them
+        groups = cp_package.get('geometry_groups', 1)
+        x_groups = rearrange(x, '(g b) m c h w -> b m (g c) h w', g=groups)
+
+        # features of every (view, padded neighbor) pair, sampled with one grid_sample call
+        x_right = x_groups[torch.arange(b//groups, device=x.device)[:, None, None], geometry.neighbor_index]
+        key_value = F.grid_sample(rearrange(x_right, 'b m k c h w -> (b m k) c h w'),
+                                  rearrange(level.grids, 'b m k h w c -> (b m k) h w c'), align_corners=True)
+        key_value = rearrange(key_value, '(b m k) (g c) h w -> g (b m h w) k c', b=b//groups, m=m, g=groups)
+
+        # embeddings and masks of one batch group, broadcast over the groups: (key_value + key_value_pe)*mask
+        key_value_pe, mask, query_pe = level.positional_encodings(self.pe, c, b*m*h*w)
+        key_value = torch.addcmul(key_value_pe, key_value, mask)
+        key_value = rearrange(key_value, 'g n k c -> (g n) k c')
+
+        query = rearrange(x, 'b m c h w -> (b m h w) c')[:, None]
+
+        # padded neighbors are left out of the attention
+        valid = repeat(geometry.neighbor_valid, 'b m k -> (g b m h w) k', g=groups, h=h, w=w)
+        out = self.transformer(query, key_value, query_pe, mask=valid)
+
+        out = rearrange(out[:, 0], '(b m h w) c -> (b m) c h w', b=b, m=m, h=h, w=w)
       
         return out
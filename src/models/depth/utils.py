@@ -1,8 +1,10 @@
 
 import torch
-import torch.nn.functional as F
 from einops import rearrange
-from ..modules.utils import back_projection, get_x_2d
+import hashlib
+import threading
+from collections import OrderedDict
+from ..modules.utils import back_projection
 
 
 
@@ -20,98 +22,328 @@ def get_correspondence(depth, pose, K, x_2d):
 
     return x2d, x3d
 
-def get_key_value(key_value, xy_l, xy_r, depth_query, depths, pose_rel, K, ori_h, ori_w, ori_h_r, ori_w_r, query_h, query_w):
-
-    b, c, h, w = key_value.shape
-    query_scale = ori_h//query_h
-    key_scale = ori_h_r//h
-
-    xy_l = xy_l[:, query_scale//2::query_scale,
-                query_scale//2::query_scale]/key_scale-0.5
-
-    key_values = []
-
-    xy_proj = []
-    depth_proj = []
-    mask_proj = []
-    kernal_size = 1
-    depth_query = depth_query[:, query_scale//2::query_scale,query_scale//2::query_scale]
-    for i in range(0-kernal_size//2, 1+kernal_size//2):
-        for j in range(0-kernal_size//2, 1+kernal_size//2):
-            xy_l_norm = xy_l.clone()
-            # displacement
-            xy_l_norm[..., 0] = xy_l_norm[..., 0] + i
-            xy_l_norm[..., 1] = xy_l_norm[..., 1] + j
-            xy_l_rescale = (xy_l_norm+0.5)*key_scale
-            xy_l_round = xy_l_rescale.round().long()
-            mask = (xy_l_round[..., 0] >= 0)*(xy_l_round[..., 0] < ori_w) * (
-                xy_l_round[..., 1] >= 0)*(xy_l_round[..., 1] < ori_h)
-            xy_l_round[..., 0] = torch.clamp(xy_l_round[..., 0], 0, ori_w-1)
-            xy_l_round[..., 1] = torch.clamp(xy_l_round[..., 1], 0, ori_h-1)
-
-            depth_i = torch.stack([depths[b_i, xy_l_round[b_i, ..., 1], xy_l_round[b_i, ..., 0]]
-                                  for b_i in range(b)])
-            mask = mask*(depth_i > 0)
-            depth_i[~mask] = 1000000
-            depth_proj.append(depth_i)
-            
-            
-            mask_proj.append(mask*(depth_query>0))
-
-            xy_proj.append(xy_l_rescale.clone())
-
-            xy_l_norm[..., 0] = xy_l_norm[..., 0]/(w-1)*2-1
-            xy_l_norm[..., 1] = xy_l_norm[..., 1]/(h-1)*2-1
-            _key_value = F.grid_sample(
-                key_value, xy_l_norm, align_corners=True)
-            key_values.append(_key_value)
-
-    xy_proj = torch.stack(xy_proj, dim=1)
-    depth_proj = torch.stack(depth_proj, dim=1)
-    mask_proj = torch.stack(mask_proj, dim=1)
-
-    xy_proj = rearrange(xy_proj, 'b n h w c -> (b n) h w c')
-    depth_proj = rearrange(depth_proj, 'b n h w -> (b n) h w')
-
-
-    xy = get_x_2d(ori_w, ori_h)[:, :, :2]
-    xy = xy[query_scale//2::query_scale, query_scale//2::query_scale]
-    
-    xy = torch.tensor(xy, device=key_value.device).float()[
-        None].repeat(xy_proj.shape[0], 1, 1, 1)   
-    
-    xy_rel = (depth_query-depth_proj).abs()[...,None] # depth check
-
-    xy_rel = rearrange(xy_rel, '(b n) h w c -> b n h w c', b=b)
-
-    key_values = torch.stack(key_values, dim=1)
-   
-    return key_values, xy_rel, mask_proj
-
-
-def get_query_value(query, key_value, xy_l, xy_r, depth_query, depths, pose_rel, K, img_h_l, img_w_l, img_h_r=None, img_w_r=None):
-    if img_h_r is None:
-        img_h_r = img_h_l
-        img_w_r = img_w_l
-
-    b = query.shape[0]
-    m = key_value.shape[1]
-
-    key_values = []
-    masks = []
-    xys = []
+def depth_check(xy_l, depth_query, depths, index, ori_h, ori_w, key_scale, h, w, kernal_size=1):
+    """
+    Sample positions and depth checks for N (query, key view) pairs at once, the depth
+    lookup of all pairs and kernel offsets is a single advanced-indexing gather.
+        xy_l:        (N, q_h, q_w, 2) correspondences of the query pixels in the key view (original pixels)
+        depth_query: (N, q_h, q_w) depths of the query pixels
+        depths:      (V, ori_h, ori_w) depth maps, index (N,) the key view of each pair in it
+    Returns grids (N, n, q_h, q_w, 2) normalized for an (h, w) key feature map, depth checks
+    xy_rel (N, n, q_h, q_w, 1) and masks (N, n, q_h, q_w), n = kernal_size**2 offsets.
+    """
+    offsets = [(i, j) for i in range(0-kernal_size//2, 1+kernal_size//2)
+               for j in range(0-kernal_size//2, 1+kernal_size//2)]
+    offsets = torch.tensor(offsets, dtype=xy_l.dtype, device=xy_l.device)
 
+    # displacement
+    xy_l = (xy_l/key_scale-0.5)[:, None] + offsets[None, :, None, None]
+    xy_l_rescale = (xy_l+0.5)*key_scale
+    xy_l_round = xy_l_rescale.round().long()
+    x_round, y_round = xy_l_round[..., 0], xy_l_round[..., 1]
+    mask = (x_round >= 0)*(x_round < ori_w)*(y_round >= 0)*(y_round < ori_h)
+
+    depth_proj = depths[index[:, None, None, None], y_round.clamp(0, ori_h-1), x_round.clamp(0, ori_w-1)]
+    depth_query = depth_query[:, None]
+    mask = mask*(depth_proj > 0)
+    depth_proj = depth_proj.masked_fill(~mask, 1000000)
+    mask = mask*(depth_query > 0)
+
+    grids = torch.stack([xy_l[..., 0]/(w-1)*2-1, xy_l[..., 1]/(h-1)*2-1], dim=-1)
+    xy_rel = (depth_query-depth_proj).abs()[..., None] # depth check
+    return grids, xy_rel, mask
+
+
+def get_overlap(correspondence, overlap_filter):
+    """Overlap ratios (b, m, m) of the view pairs, made symmetric with the smaller ratio, and the pairs above overlap_filter."""
+    b, m, _, h, w, _ = correspondence.shape
+    inside = (correspondence[..., 0]>=0)&(correspondence[..., 0]<w)&(correspondence[..., 1]>=0)&(correspondence[..., 1]<h)
+    overlap_ratios = rearrange(inside, 'b i j h w -> b i j (h w)').float().mean(dim=-1)
+    overlap_ratios = torch.minimum(overlap_ratios, overlap_ratios.transpose(1, 2))
+    overlap_mask=overlap_ratios>overlap_filter # filter image pairs that have too small overlaps
+    return overlap_ratios, overlap_mask
+
+
+def get_neighbors(overlap_mask, overlap_ratios=None, top_k=None):
+    """
+    Per batch item and view, the views CPAttn attends to: overlapping views (only the top_k with the
+    largest overlap_ratios if top_k is set), or the adjacent ones if there are none.
+    """
+    overlap_mask = overlap_mask.cpu()
+    if top_k is not None:
+        overlap_ratios = overlap_ratios.cpu()
+    b, m, _ = overlap_mask.shape
+    neighbors = []
+    for b_i in range(b):
+        _neighbors = []
+        for i in range(m):
+            indexs = [j for j in range(m) if overlap_mask[b_i, i, j] and i!=j]
+            if top_k is not None and len(indexs)>top_k:
+                indexs = sorted(sorted(indexs, key=lambda j: -overlap_ratios[b_i, i, j].item())[:top_k])
+            if len(indexs)==0: # if the image does not have overlap with others, use the nearby images
+                if i==0:
+                    indexs=[1]
+                elif i==m-1:
+                    indexs=[m-2]
+                else:
+                    indexs=[i-1, i+1]
+            _neighbors.append(indexs)
+        neighbors.append(_neighbors)
+    return neighbors
+
+
+def pad_neighbors(neighbors, device=None):
+    """Neighbor lists padded to the largest count k: indices (b, m, k) (padding repeats view 0) and validity (b, m, k)."""
+    k = max(len(indexs) for _neighbors in neighbors for indexs in _neighbors)
+    index = torch.zeros(len(neighbors), len(neighbors[0]), k, dtype=torch.long)
+    valid = torch.zeros(len(neighbors), len(neighbors[0]), k, dtype=torch.bool)
+    for b_i, _neighbors in enumerate(neighbors):
+        for i, indexs in enumerate(_neighbors):
+            index[b_i, i, :len(indexs)] = torch.tensor(indexs)
+            valid[b_i, i, :len(indexs)] = True
+    return index.to(device), valid.to(device)
+
+
+def pe_pairs(xy_rel, counts):
+    """
+    PosEmbedding embeds its input two values at a time: CPAttn's 1-channel depth checks of view i, laid
+    out as (h w l) for its l neighbors, were embedded pairwise, each slot taking the sin or cos half of
+    its pair. For padded (b, m, k, h, w, 1) depth checks and the neighbor counts (b, m), returns the value
+    pairs (b, m, k, h, w, 2) and whether each slot takes the cos half (b, m, k, h, w), so that padded
+    slots do not change the embeddings of the valid ones.
+    """
+    b, m, k, h, w, _ = xy_rel.shape
+    n = torch.arange(h*w, device=xy_rel.device)[None, None, None]
+    s = torch.arange(k, device=xy_rel.device)[None, None, :, None]
+    l = counts[:, :, None, None]
+    q = n*l+s
+    q_even = q-q%2
+
+    values = rearrange(xy_rel, 'b m k h w c -> b m (k h w c)')
+    pairs = []
+    for _q in (q_even, q_even+1):
+        # out of range positions only occur for padded slots, their embeddings are masked out
+        index = ((_q%l).clamp(max=k-1)*h*w+_q//l).clamp(max=k*h*w-1)
+        pairs.append(torch.gather(values, 2, rearrange(index, 'b m k n -> b m (k n)')))
+    pairs = rearrange(torch.stack(pairs, dim=-1), 'b m (k h w) c -> b m k h w c', k=k, h=h)
+    odd = rearrange(q%2 == 1, 'b m k (h w) -> b m k h w', h=h)
+    return pairs, odd
+
+
+class DepthLevel:
+    """
+    CPAttn geometry of one feature resolution for all views, neighbors padded to k:
+        grids:  (b, m, k, h, w, 2) normalized grid_sample positions in the neighbor views
+        xy_rel: (b, m, k, h, w, 1) depth checks
+        mask:   (b, m, k, h, w) valid samples, False for padded neighbors
+        pe_xy, pe_odd: depth check pairs and halves for PosEmbedding, see pe_pairs
+    Their positional encodings are cached with the level per PosEmbedding.key (positional_encodings).
+    """
+
+    def __init__(self, grids, xy_rel, mask, pe_xy, pe_odd):
+        self.grids = grids
+        self.xy_rel = xy_rel
+        self.mask = mask
+        self.pe_xy = pe_xy
+        self.pe_odd = pe_odd
+        self._pe = {}
+
+    def positional_encodings(self, pe, c, rows):
+        """
+        (key_pe, mask, query_pe) of PosEmbedding pe for c channel features, computed once per level:
+            key_pe:   ((b m h w), k, c) embedding of the depth checks, zero for the masked samples
+            mask:     ((b m h w), k, 1) mask as a float multiplier
+            query_pe: (rows, 1, c) embedding of the query depth check 0 for `rows` query pixels
+        """
+        key = (pe.key, c)
+        encodings = self._pe.get(key)
+        if encodings is None:
+            key_pe = pe(self.pe_xy)
+            key_pe = torch.where(self.pe_odd[..., None], key_pe[..., c:], key_pe[..., :c])
+            key_pe = rearrange(key_pe, 'b m k h w c -> (b m h w) k c')
+            mask = rearrange(self.mask, 'b m k h w -> (b m h w) k')[..., None]
+            encodings = self._pe[key] = (key_pe*mask, mask.to(key_pe.dtype))
+
+        query_key = (pe.key, rows)
+        query_pe = self._pe.get(query_key)
+        if query_pe is None:
+            query_pe = self._pe[query_key] = pe(torch.zeros(rows, 1, 1, device=self.pe_xy.device))
+        return (*encodings, query_pe)
+
+
+class DepthGeometry:
+    """
+    Everything the depth-conditioned CPAttn derives from poses, K and depths, which do not change while
+    sampling: full resolution correspondences, overlap ratios / masks, the neighbor views of every view
+    (as lists and padded to k) and, per feature resolution, a DepthLevel (built on first use).
+    Correspondences are either dense (b, m, m, h, w, 2), or, with neighbor selection (see get_geometry),
+    only those of the padded neighbor slots: neighbor_xy (b, m, k, h, w, 2) and correspondence None.
+    """
+
+    def __init__(self, depths, correspondence, overlap_ratios, overlap_mask, neighbors=None, neighbor_xy=None):
+        self.depths = depths
+        self.correspondence = correspondence
+        self.overlap_ratios = overlap_ratios
+        self.overlap_mask = overlap_mask
+        self.neighbors = get_neighbors(overlap_mask) if neighbors is None else neighbors
+        self.neighbor_index, self.neighbor_valid = pad_neighbors(self.neighbors, depths.device)
+        self.neighbor_xy = neighbor_xy
+        self._levels = {}
+
+    def level(self, img_h, img_w, h, w):
+        """DepthLevel of the feature size (h, w)."""
+        key = (img_h, img_w, h, w)
+        level = self._levels.get(key)
+        if level is None:
+            level = self._levels[key] = self._build_level(img_h, img_w, h, w)
+        return level
+
+    def _build_level(self, img_h, img_w, h, w):
+        b, m, k = self.neighbor_index.shape
+        scale = img_h//h
+        b_index = torch.arange(b, device=self.depths.device)[:, None, None]
+
+        # all (b, view, padded neighbor) pairs at the query pixels of this level
+        if self.neighbor_xy is not None:
+            xy_l = self.neighbor_xy[:, :, :, scale//2::scale, scale//2::scale]
+        else:
+            xy_l = self.correspondence[:, :, :, scale//2::scale, scale//2::scale]
+            xy_l = xy_l[b_index, torch.arange(m, device=self.depths.device)[None, :, None], self.neighbor_index]
+        depth_query = self.depths[:, :, None, scale//2::scale, scale//2::scale].expand(-1, -1, k, -1, -1)
+        index = b_index*m+self.neighbor_index
+
+        grids, xy_rel, mask = depth_check(
+            xy_l.flatten(0, 2), depth_query.flatten(0, 2), self.depths.flatten(0, 1), index.flatten(),
+            img_h, img_w, scale, h, w)
+        grids, xy_rel, mask = (rearrange(t, '(b m k) n ... -> b m (k n) ...', b=b, m=m)
+                               for t in (grids, xy_rel, mask))
+        mask = mask*self.neighbor_valid[..., None, None]
+        pe_xy, pe_odd = pe_pairs(xy_rel, self.neighbor_valid.sum(dim=-1))
+        return DepthLevel(grids, xy_rel, mask, pe_xy, pe_odd)
+
+
+def get_pair_correspondence(poses, K, depths, left, right):
+    """Correspondences (b, e, h, w, 2) of the pixels of views left in views right, left / right: (b, e) view indices."""
+    b, m, h, w = depths.shape
+    e = left.shape[1]
+    b_index = torch.arange(b, device=depths.device)[:, None]
+    pose_rel = torch.inverse(poses[b_index, right])@poses[b_index, left]
+    point, _ = get_correspondence(
+        depths[b_index, left].flatten(0, 1), pose_rel.flatten(0, 1), K[:, None].expand(-1, e, -1, -1).flatten(0, 1), None)
+    return rearrange(point, '(b e) h w c -> b e h w c', b=b)
+
+
+def get_sparse_geometry(poses, K, depths, overlap_filter, top_k=None, window=None):
+    """
+    get_geometry with neighbor selection: only view pairs at most window views apart are considered and each
+    view keeps its top_k overlapping views. Overlap ratios are computed one view at a time and only the
+    correspondences of the selected pairs are kept, so memory grows with m*k instead of m*m.
+    """
+    b, m, h, w = depths.shape
+    device = depths.device
+    window = m if window is None else window
+
+    overlap_ratios = torch.zeros(b, m, m, device=device)
     for i in range(m):
-        _, _, q_h, q_w = query.shape
-        _key_value, _xy, _mask = get_key_value(key_value[:, i], xy_l[:, i], xy_r[:, i], depth_query, depths[:, i], pose_rel[:, i], K,
-                                               img_h_l, img_w_l, img_h_r, img_w_r, q_h, q_w)
+        right = list(range(max(0, i-window), min(m, i+window+1)))
+        point_ij = get_pair_correspondence(poses, K, depths, torch.full((b, len(right)), i, device=device),
+                                           torch.tensor(right, device=device)[None].expand(b, -1))
+        inside = (point_ij[..., 0]>=0)&(point_ij[..., 0]<w)&(point_ij[..., 1]>=0)&(point_ij[..., 1]<h)
+        overlap_ratios[:, i, right] = rearrange(inside, 'b e h w -> b e (h w)').float().mean(dim=-1)
+    overlap_ratios = torch.minimum(overlap_ratios, overlap_ratios.transpose(1, 2))
+    overlap_mask = overlap_ratios>overlap_filter # filter image pairs that have too small overlaps
+
+    neighbors = get_neighbors(overlap_mask, overlap_ratios, top_k)
+    neighbor_index, _ = pad_neighbors(neighbors, device)
+    k = neighbor_index.shape[-1]
+    neighbor_xy = torch.zeros(b, m, k, h, w, 2, device=device)
+    for i in range(m):
+        neighbor_xy[:, i] = get_pair_correspondence(poses, K, depths, torch.full((b, k), i, device=device),
+                                                    neighbor_index[:, i])
+    return DepthGeometry(depths, None, overlap_ratios, overlap_mask, neighbors, neighbor_xy)
+
+
+def get_geometry(poses, K, depths, overlap_filter, top_k=None, window=None):
+    """
+    DepthGeometry of the views (poses (b, m, 4, 4), K (b, 4, 4), depths (b, m, h, w)). By default every view
+    attends to all views it overlaps with; top_k / window select neighbors, see get_sparse_geometry.
+    """
+    if top_k is not None or window is not None:
+        return get_sparse_geometry(poses, K, depths, overlap_filter, top_k, window)
+    b, m, h, w = depths.shape
+
+    correspondence = torch.zeros(b, m, m, h, w, 2, device=depths.device)
+    K = K[:, None].repeat(1, m, 1, 1)
+    K = rearrange(K, 'b m h w -> (b m) h w')
+
+    for i in range(m):
+        pose_i = poses[:, i:i+1].repeat(1, m, 1, 1)
+        depth_i = depths[:, i:i+1].repeat(1, m, 1, 1)
+        pose_j = poses
+        depth_i = rearrange(depth_i, 'b m h w -> (b m) h w')
+        pose_j = rearrange(pose_j, 'b m h w -> (b m) h w')
+        pose_i = rearrange(pose_i, 'b m h w -> (b m) h w')
+        pose_rel = torch.inverse(pose_j)@pose_i
+        point_ij, _ = get_correspondence(
+            depth_i, pose_rel, K, None)  # bs, 2, hw
+        point_ij = rearrange(point_ij, '(b m) h w c -> b m h w c', b=b)
+        correspondence[:, i] = point_ij
+    overlap_ratios, overlap_mask = get_overlap(correspondence, overlap_filter)
+    return DepthGeometry(depths, correspondence, overlap_ratios, overlap_mask)
+
+
+class GeometryCache:
+    """
+    Bounded LRU cache of get_geometry results.
+
+    Repeated sampling runs over the same views (e.g. the same ScanNet sequence) share one DepthGeometry.
+    Entries are keyed by a hash of (poses, K, depths), the neighbor selection and the device. Full resolution
+    correspondences take b*m*m*h*w*2 floats, so only a few entries are kept; cached tensors are shared
+    and must not be modified.
+    """
+
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(poses, K, depths, overlap_filter, top_k=None, window=None):
+        digest = hashlib.sha1()
+        for t in (poses, K, depths):
+            t = t.detach().float().cpu()
+            digest.update(str(tuple(t.shape)).encode())
+            digest.update(t.numpy().tobytes())
+        return digest.hexdigest(), float(overlap_filter), top_k, window, str(depths.device)
+
+    def get(self, poses, K, depths, overlap_filter, top_k=None, window=None):
+        key = self.key(poses, K, depths, overlap_filter, top_k, window)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = get_geometry(poses, K, depths, overlap_filter, top_k, window)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
-        key_values.append(_key_value)
-        xys.append(_xy)
-        masks.append(_mask)
+geometry_cache = GeometryCache()
 
-    key_value = torch.cat(key_values, dim=1)
-    xy = torch.cat(xys, dim=1)
-    mask = torch.cat(masks, dim=1)
 
-    return query, key_value, xy, mask
\ No newline at end of file
+def cached_geometry(poses, K, depths, overlap_filter, top_k=None, window=None):
+    """get_geometry through geometry_cache; computed fresh while autograd is recording."""
+    if torch.is_grad_enabled():
+        return get_geometry(poses, K, depths, overlap_filter, top_k, window)
+    return geometry_cache.get(poses, K, depths, overlap_filter, top_k, window)
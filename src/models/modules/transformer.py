@@ -1,7 +1,8 @@
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
-from einops import rearrange
+from functools import partial, wraps
+from einops import rearrange, repeat
 
 
 class GEGLU(nn.Module):
@@ -13,6 +14,10 @@ class GEGLU(nn.Module):
         x, gate = self.proj(x).chunk(2, dim=-1)
         return x * F.gelu(gate)
 
+    def forward_inference(self, x):
+        x, gate = self.proj(x).chunk(2, dim=-1)
+        return F.gelu(gate).mul_(x)
+
 
 class FeedForward(nn.Module):
     def __init__(self, dim, dim_out=None, mult=4, glu=False, dropout=0.):
@@ -36,8 +41,40 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.net(x)
 
+    def forward_inference(self, x, residual):
+        """forward(x) + residual without autograd, intermediate tensors are updated in place."""
+        project_in, _, linear = self.net
+        x = project_in.forward_inference(x) if isinstance(project_in, GEGLU) else project_in(x)
+        return linear(x).add_(residual)
+
+
+def single_query_attention(q, k, v, heads, scale, mask=None):
+    """
+    Attention of one query token over N context tokens, the layout of the CP blocks (one row per pixel).
+    q: (b, 1, heads*d), k / v: (b, N, heads*d), mask: (b, N) bool, False for context entries to leave out.
+    Heads are split with views and the whole reduction runs in scaled_dot_product_attention.
+    """
+    if mask is not None:
+        # rows without any valid entry average all of them, like the einsum path's masked softmax (equal logits),
+        # instead of the NaN scaled_dot_product_attention returns: unmask them and zero their query
+        empty = ~mask.any(dim=-1)
+        mask = mask | empty[:, None]
+        q = q.masked_fill(empty[:, None, None], 0)
+    q, k, v = map(lambda t: t.unflatten(-1, (heads, -1)).transpose(1, 2), (q, k, v))
+    # scaled_dot_product_attention of torch 2.0 has no scale argument and always scales by d**-0.5
+    default_scale = q.shape[-1] ** -0.5
+    if scale != default_scale:
+        q = q * (scale / default_scale)
+    if mask is not None:
+        mask = mask[:, None, None]
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    return out.transpose(1, 2).flatten(2)
+
 
 class CrossAttention(nn.Module):
+    # single-query inputs use single_query_attention instead of the einsum path, switched on by inference_mode
+    fused = False
+
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
         super().__init__()
         inner_dim = dim_head * heads
@@ -62,6 +99,9 @@ class CrossAttention(nn.Module):
         k = self.to_k(context)
         v = self.to_v(context)
 
+        if self.fused and q.shape[1] == 1:
+            return self.to_out(single_query_attention(q, k, v, h, self.scale, mask))
+
         q, k, v = map(lambda t: rearrange(
             t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
@@ -70,6 +110,11 @@ class CrossAttention(nn.Module):
 
         del q, k
 
+        if mask is not None:
+            # mask: (b, j) bool, False for context entries to leave out
+            mask = repeat(mask, 'b j -> (b h) () j', h=h)
+            sim.masked_fill_(~mask, -torch.finfo(sim.dtype).max)
+
         sim = sim.softmax(dim=-1)
 
         out = einsum('b i j, b j d -> b i d', sim, v)
@@ -144,14 +189,18 @@ class BasicTransformerBlock(nn.Module):
 
         self.checkpoint = checkpoint
         self.use_checkpoint=use_checkpoint
+        # set by inference_mode: no checkpointing, fused residuals (only valid without autograd)
+        self.inference=False
 
-    def forward(self, x, context=None, query_pe=None):
+    def forward(self, x, context=None, query_pe=None, mask=None):
+        if self.inference:
+            return self._forward_inference(x, context, query_pe, mask)
         if self. use_checkpoint:
-            return checkpoint(self._forward, (x, context, query_pe), self.parameters(), self.checkpoint)
+            return checkpoint(partial(self._forward, mask=mask), (x, context, query_pe), self.parameters(), self.checkpoint)
         else:
-            return self._forward(x, context, query_pe)
+            return self._forward(x, context, query_pe, mask)
 
-    def _forward(self, x, context=None, query_pe=None):
+    def _forward(self, x, context=None, query_pe=None, mask=None):
         if context is None:
             context = x
         query=x
@@ -160,11 +209,41 @@ class BasicTransformerBlock(nn.Module):
         query=self.norm1(query)
         context=self.norm1(context)
         x = self.attn1(query,
-                       context=context) + x
+                       context=context, mask=mask) + x
         x = self.ff(self.norm2(x)) + x
 
         return x
 
+    def _forward_inference(self, x, context=None, query_pe=None, mask=None):
+        if context is None:
+            context = x
+        query = x if query_pe is None else x+query_pe
+        x = self.attn1(self.norm1(query), context=self.norm1(context), mask=mask).add_(x)
+        return self.ff.forward_inference(self.norm2(x), x)
+
+
+def inference_mode(method):
+    """
+    Decorator for the sampling methods of the generators: runs the method under torch.inference_mode with the
+    BasicTransformerBlocks of self.mv_base_model (the CP blocks) switched to their inference path and their
+    attention to single_query_attention (CrossAttention.fused).
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        blocks = [module for module in self.mv_base_model.modules() if isinstance(module, BasicTransformerBlock)]
+        switches = [(block, 'inference') for block in blocks] + \
+            [(module, 'fused') for block in blocks for module in block.modules() if isinstance(module, CrossAttention)]
+        previous = [getattr(module, name) for module, name in switches]
+        for module, name in switches:
+            setattr(module, name, True)
+        try:
+            with torch.inference_mode():
+                return method(self, *args, **kwargs)
+        finally:
+            for (module, name), flag in zip(switches, previous):
+                setattr(module, name, flag)
+    return wrapper
+
 
 class PosEmbedding(nn.Module):
     def __init__(self, in_channels, N_freqs, logscale=True):
@@ -175,6 +254,7 @@ class PosEmbedding(nn.Module):
         super(PosEmbedding, self).__init__()
         self.N_freqs = N_freqs
         self.in_channels = in_channels
+        self.logscale = logscale
         # self.funcs = [torch.sin, torch.cos]
         # self.out_channels = in_channels*(len(self.funcs)*N_freqs)
         if N_freqs <= 80:
@@ -188,6 +268,11 @@ class PosEmbedding(nn.Module):
             freq_bands = torch.linspace(1, 2**(N_freqs-1), N_freqs)
         self.register_buffer('freq_bands', freq_bands)
 
+    @property
+    def key(self):
+        """Embeddings with the same key compute the same function, e.g. for caching their outputs."""
+        return self.in_channels, self.N_freqs, self.logscale, self.freq_bands.dtype, self.freq_bands.device
+
     def forward(self, x):
         """
         Embeds x to (x, sin(2^k x), cos(2^k x), ...) 
@@ -1,5 +1,5 @@
+import threading
 import torch
-import numpy as np
 from einops import rearrange
 
 def pi_inv(K, x, d):
@@ -33,8 +33,8 @@ def transpose(R, t, X):
 def back_projection(depth, pose, K, x_2d=None):
     b, h, w = depth.shape
     if x_2d is None:
-        x_2d = x_2d_coords(h, w, device=depth.device)[
-            None, ...].repeat(b, 1, 1, 1)
+        x_2d = coordinate_grid(h, w, device=depth.device)[
+            None, ...].expand(b, -1, -1, -1)
 
     X_3d = pi_inv(K, x_2d, depth)
 
@@ -44,20 +44,30 @@ def back_projection(depth, pose, K, x_2d=None):
     X_world = X_world.reshape((-1, h, w, 3))
     return X_world
 
-def get_x_2d(width, height):
-    x = np.arange(width)
-    y = np.arange(height)
-    x, y = np.meshgrid(x, y)
-    z = np.ones_like(x)
-    xyz = np.concatenate(
-        [x[..., None], y[..., None], z[..., None]], axis=-1).astype(np.float32)
-    return xyz
-
-
-def x_2d_coords(h, w, device):
-    x_2d = torch.zeros((h, w, 2), device=device)
-    for y in range(0, h):
-        x_2d[y, :, 1] = y
-    for x in range(0, w):
-        x_2d[:, x, 0] = x
-    return x_2d
+
+# (h, w, stride, offset, homogeneous, dtype, device) -> shared coordinate grid
+_coordinate_grids = {}
+_coordinate_grids_lock = threading.Lock()
+
+
+def coordinate_grid(h, w, stride=1, offset=0, homogeneous=False, dtype=torch.float32, device='cpu'):
+    """
+    Pixel coordinates (x, y) of the pixels [offset::stride, offset::stride] of an (h, w) image, as an
+    (h', w', 2) tensor, or (h', w', 3) with a trailing 1 if homogeneous.
+    Grids are built on the device on first use and shared afterwards: treat them as read-only.
+    """
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    key = (h, w, stride, offset, homogeneous, dtype, device)
+    grid = _coordinate_grids.get(key)
+    if grid is None:
+        # normal tensors even when first requested under torch.inference_mode, training reuses them
+        with torch.inference_mode(False):
+            y, x = torch.meshgrid(torch.arange(offset, h, stride, dtype=dtype, device=device),
+                                  torch.arange(offset, w, stride, dtype=dtype, device=device), indexing='ij')
+            grid = [x, y, torch.ones_like(x)] if homogeneous else [x, y]
+            grid = torch.stack(grid, dim=-1)
+        with _coordinate_grids_lock:
+            grid = _coordinate_grids.setdefault(key, grid)
+    return grid
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 from .modules import CPAttn
 from einops import rearrange
-from .utils import get_correspondences
+from .utils import cached_correspondences
 
 
 class MultiViewBaseModel(nn.Module):
@@ -35,10 +35,14 @@ class MultiViewBaseModel(nn.Module):
     def forward(self, latents, timestep, prompt_embd, meta):
         K = meta['K']
         R = meta['R']
+        # shared geometry across batch groups: the batch is `groups` copies of the views of R / K
+        # (classifier-free guidance pairs), geometry is computed once and broadcast over the groups
+        groups = meta.get('geometry_groups', 1)
         
         b, m, c, h, w = latents.shape
         img_h, img_w = h*8, w*8
-        correspondences=get_correspondences(R, K, img_h, img_w)
+        # identical for every denoising step of a rig, see CorrespondenceCache
+        correspondences=cached_correspondences(R, K, img_h, img_w)
 
         # bs*m, 4, 64, 64
         hidden_states = rearrange(latents, 'b m c h w -> (b m) c h w')
@@ -72,7 +76,7 @@ class MultiViewBaseModel(nn.Module):
                     down_block_res_samples += (hidden_states,)
             if m > 1:
                 hidden_states = self.cp_blocks_encoder[i](
-                    hidden_states, correspondences, img_h, img_w, R, K, m)
+                    hidden_states, correspondences, img_h, img_w, R, K, m, groups)
 
             if downsample_block.downsamplers is not None:
                 for downsample in downsample_block.downsamplers:
@@ -86,7 +90,7 @@ class MultiViewBaseModel(nn.Module):
 
         if m > 1:
             hidden_states = self.cp_blocks_mid(
-                hidden_states, correspondences, img_h, img_w, R, K, m)
+                hidden_states, correspondences, img_h, img_w, R, K, m, groups)
 
         for attn, resnet in zip(self.unet.mid_block.attentions, self.unet.mid_block.resnets[1:]):
             hidden_states = attn(
@@ -121,7 +125,7 @@ class MultiViewBaseModel(nn.Module):
                     hidden_states = resnet(hidden_states, emb)
             if m > 1:
                 hidden_states = self.cp_blocks_decoder[i](
-                    hidden_states,correspondences, img_h, img_w, R, K, m)
+                    hidden_states,correspondences, img_h, img_w, R, K, m, groups)
 
             if upsample_block.upsamplers is not None:
                 for upsample in upsample_block.upsamplers:
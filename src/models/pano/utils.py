@@ -1,76 +1,161 @@
+import hashlib
+import threading
+from collections import OrderedDict
 import torch
 import torch.nn.functional as F
-from ..modules.utils import get_x_2d
+from ..modules.utils import coordinate_grid
 from einops import rearrange
 
 
-def get_correspondences(R, K, img_h, img_w):
-    m=R.shape[1]
-    
-    correspondences=torch.zeros((R.shape[0], m, m, img_h, img_w, 2), device=R.device)
-    for i in range(m):  
-        for j in range(m):
-
-            R_right = R[:, j:j+1]
-            K_right = K[:, j:j+1]
-            l = R_right.shape[1]
-
-            R_left = R[:, i:i+1].repeat(1, l, 1, 1)
-            K_left = K[:, i:i+1].repeat(1, l, 1, 1)
-
-            R_left = R_left.reshape(-1, 3, 3)
-            R_right = R_right.reshape(-1, 3, 3)
-            K_left = K_left.reshape(-1, 3, 3)
-            K_right = K_right.reshape(-1, 3, 3)
-
-            homo_l = (K_right@torch.inverse(R_right) @
-                    R_left@torch.inverse(K_left))
-            
-
-            xyz_l = torch.tensor(get_x_2d(img_w, img_h),
-                                device=R.device)
-            xyz_l = (
-                xyz_l.reshape(-1, 3).T)[None].repeat(homo_l.shape[0], 1, 1)
-            
-            xyz_l = homo_l@xyz_l 
-            
-
-            xy_l = (xyz_l[:, :2]/xyz_l[:, 2:]).permute(0,
-                                                    2, 1).reshape(-1, l, img_h, img_w, 2)
-            
-            correspondences[:,i,j]=xy_l[:,0]
-    return correspondences
-
-
-def get_key_value(key_value, xy_l, homo_r, ori_h, ori_w, ori_h_r, query_h):
-    
-    b, c, h, w = key_value.shape
-    query_scale = ori_h//query_h
-    key_scale = ori_h_r//h
-
-    xy_l = xy_l[:, query_scale//2::query_scale,
-                query_scale//2::query_scale]/key_scale-0.5
+def ring_neighbors(m):
+    """Views pano CPAttn attends to from view i: its left and right neighbor on the 360 ring."""
+    return [[(i-1+m) % m, (i+1) % m] for i in range(m)]
+
+
+class NeighborCorrespondences:
+    """
+    Correspondences of the neighbor graph only, the pairs pano CPAttn reads instead of all m x m. For a
+    rotating rig they follow from one homography per pair, so they are computed directly at the query
+    pixels of each feature level (xy_at) and the full resolution grid is never built.
+        homo_l:    (b, e, 3, 3) homographies of the e = m*n pairs (i, neighbors[i][k]), view i -> neighbor
+        homo_r:    (b, e, 3, 3) the same pairs, neighbor -> view i
+        neighbors: m lists of n view indices
+    """
+
+    def __init__(self, homo_l, homo_r, neighbors, img_h, img_w):
+        self.homo_l = homo_l
+        self.homo_r = homo_r
+        self.neighbors = neighbors
+        self.neighbor_index = torch.tensor(neighbors, device=homo_l.device)
+        self.img_h = img_h
+        self.img_w = img_w
+        self._xy = {}
+        self._plans = {}
+
+    @property
+    def m(self):
+        return len(self.neighbors)
+
+    @property
+    def nbytes(self):
+        return sum(xy.numel() * xy.element_size() for xy in self._xy.values())
+
+    def xy_at(self, scale=1):
+        """
+        (b, m, n, img_h/scale, img_w/scale, 2): xy[:, i, k] is the position in view neighbors[i][k] of the pixels
+        [scale//2::scale, scale//2::scale] of view i, projected with the homography of the pair.
+        """
+        xy = self._xy.get(scale)
+        if xy is None:
+            xyz_l = coordinate_grid(self.img_h, self.img_w, scale, scale//2, homogeneous=True, device=self.homo_l.device)
+            h, w = xyz_l.shape[:2]
+            xyz_l = self.homo_l@xyz_l.reshape(-1, 3).T
+            xy = (xyz_l[:, :, :2]/xyz_l[:, :, 2:]).permute(0, 1, 3, 2)
+            xy = self._xy[scale] = xy.reshape(xy.shape[0], self.m, -1, h, w, 2)
+        return xy
+
+    def sampling_plan(self, h, w):
+        """CPSamplingPlan of the (h, w) feature level, built on first use and kept with the correspondences."""
+        plan = self._plans.get((h, w))
+        if plan is None:
+            plan = self._plans[(h, w)] = build_sampling_plan(self, h, w)
+        return plan
+
+
+def get_neighbor_correspondences(R, K, img_h, img_w, neighbors=None):
+    """
+    Correspondences of the (i, neighbors[i][k]) view pairs (ring_neighbors by default) of a rotating rig.
+    Only the homographies are computed here, positions are projected per feature level on demand.
+    """
+    neighbors = ring_neighbors(R.shape[1]) if neighbors is None else neighbors
+    left = torch.tensor([i for i, js in enumerate(neighbors) for _ in js], device=R.device)
+    right = torch.tensor([j for js in neighbors for j in js], device=R.device)
+
+    homo_l = K[:, right]@torch.inverse(R[:, right])@R[:, left]@torch.inverse(K[:, left])    # b, e, 3, 3
+    homo_r = K[:, left]@torch.inverse(R[:, left])@R[:, right]@torch.inverse(K[:, right])
+    return NeighborCorrespondences(homo_l, homo_r, neighbors, img_h, img_w)
+
+
+class CorrespondenceCache:
+    """
+    Bounded LRU cache of get_neighbor_correspondences results.
+
+    Correspondences only depend on the camera rig and the image size, so all denoising steps of a
+    request, and every request with the same rig, can share one tensor. Entries are keyed by a hash
+    of (R, K, img_h, img_w) and the device; cached tensors are shared and must
+    not be modified.
+
+    An entry also holds the sampling plans of its UNet levels and their positional encodings, about
+    1.4 GB in fp32 for the 8-view 512x512 rig (b*m*n*9*h*w*dim floats summed over the four levels), so
+    only the most recent rig is kept by default; raise maxsize when alternating between rigs.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(R, K, img_h, img_w):
+        digest = hashlib.sha1()
+        for t in (R, K):
+            t = t.detach().float().cpu()
+            digest.update(str(tuple(t.shape)).encode())
+            digest.update(t.numpy().tobytes())
+        return digest.hexdigest(), int(img_h), int(img_w), str(R.device)
+
+    def get(self, R, K, img_h, img_w):
+        key = self.key(R, K, img_h, img_w)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = get_neighbor_correspondences(R, K, img_h, img_w)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+correspondence_cache = CorrespondenceCache()
+
+
+def cached_correspondences(R, K, img_h, img_w):
+    """get_neighbor_correspondences through correspondence_cache; computed fresh while autograd is recording."""
+    if torch.is_grad_enabled():
+        return get_neighbor_correspondences(R, K, img_h, img_w)
+    return correspondence_cache.get(R, K, img_h, img_w)
+
+
+def kernel_geometry(xy_l, homo_r, ori_h, ori_w, query_scale, key_scale, h, w):
+    """
+    Geometry of the 3x3 kernel samples in an (h, w) key feature map around xy_l (b, q_h, q_w, 2), the
+    correspondences of the query pixels [query_scale//2::query_scale] in the key image. Returns
+        grids:  (b, 9, q_h, q_w, 2) kernel sample positions, normalized for grid_sample
+        xy_rel: (b, 9, q_h, q_w, 2) samples back-projected into the query view, relative to the query pixel
+        mask:   (b, 9, q_h, q_w) samples inside the key image
+    """
+    xy_l = xy_l/key_scale-0.5
+
+    # (x, y) offsets of the kernel samples, x-major
+    kernal_size=3
+    offsets = torch.tensor([[i, j] for i in range(0-kernal_size//2, 1+kernal_size//2)
+                            for j in range(0-kernal_size//2, 1+kernal_size//2)], dtype=xy_l.dtype, device=xy_l.device)
+    xy_l_norm = xy_l[:, None] + offsets[:, None, None]
 
-    key_values = []
+    xy_proj = (xy_l_norm+0.5)*key_scale
+    grids = xy_l_norm/xy_l_norm.new_tensor([w-1, h-1])*2-1
 
-    xy_proj = []
-    kernal_size=3
-    for i in range(0-kernal_size//2, 1+kernal_size//2):
-        for j in range(0-kernal_size//2, 1+kernal_size//2):
-            xy_l_norm = xy_l.clone()
-            xy_l_norm[..., 0] = xy_l_norm[..., 0] + i
-            xy_l_norm[..., 1] = xy_l_norm[..., 1] + j
-            xy_l_rescale = (xy_l_norm+0.5)*key_scale
-
-            xy_proj.append(xy_l_rescale)
-
-            xy_l_norm[..., 0] = xy_l_norm[..., 0]/(w-1)*2-1
-            xy_l_norm[..., 1] = xy_l_norm[..., 1]/(h-1)*2-1
-            _key_value = F.grid_sample(
-                key_value, xy_l_norm, align_corners=True)
-            key_values.append(_key_value)
-
-    xy_proj = torch.stack(xy_proj, dim=1)
     mask = (xy_proj[..., 0] > 0)*(xy_proj[..., 0] < ori_w) * \
         (xy_proj[..., 1] > 0)*(xy_proj[..., 1] < ori_h)
 
@@ -80,44 +165,87 @@ def get_key_value(key_value, xy_l, homo_r, ori_h, ori_w, ori_h_r, query_h):
     xy_proj_back = homo_r@xy_proj_back
     
     xy_proj_back = rearrange(
-        xy_proj_back, 'b c (n h w) -> b n h w c', h=h, w=w)
+        xy_proj_back, 'b c (n h w) -> b n h w c', h=xy_proj.shape[2], w=xy_proj.shape[3])
     xy_proj_back = xy_proj_back[..., :2]/xy_proj_back[..., 2:]
 
-    xy = get_x_2d(ori_w, ori_h)[:, :, :2]
-    xy = xy[query_scale//2::query_scale, query_scale//2::query_scale]
-    xy = torch.tensor(xy, device=key_value.device).float()[
+    xy = coordinate_grid(ori_h, ori_w, query_scale, query_scale//2, device=xy_l.device)[
         None, None]
 
     xy_rel = (xy_proj_back-xy)/query_scale
 
-    key_values = torch.stack(key_values, dim=1)
-
-    return key_values, xy_rel, mask
-
-
-def get_query_value(query, key_value, xy_l, homo_r, img_h_l, img_w_l, img_h_r=None, img_w_r=None):
-    if img_h_r is None:
-        img_h_r = img_h_l
-        img_w_r = img_w_l
-
-    b = query.shape[0]
-    m = key_value.shape[1]
-
-    key_values = []
-    masks = []
-    xys = []
-
-    for i in range(m):
-        _, _, q_h, q_w = query.shape
-        _key_value, _xy, _mask = get_key_value(key_value[:, i], xy_l[:, i], homo_r[:, i],
-                                               img_h_l, img_w_l, img_w_r, q_h)
-
-        key_values.append(_key_value)
-        xys.append(_xy)
-        masks.append(_mask)
-
-    key_value = torch.cat(key_values, dim=1)
-    xy = torch.cat(xys, dim=1)
-    mask = torch.cat(masks, dim=1)
-
-    return query, key_value, xy, mask
+    return grids, xy_rel, mask
+
+
+def sample_key_value(key_value, grids):
+    """(b, c, h, w) key features sampled at (b, n, q_h, q_w, 2) grids -> (b, n, c, q_h, q_w)."""
+    # one grid_sample, the n grids stacked along the output height
+    n = grids.shape[1]
+    key_value = F.grid_sample(key_value, rearrange(grids, 'b n h w c -> b (n h) w c'), align_corners=True)
+    return rearrange(key_value, 'b c (n h) w -> b n c h w', n=n)
+
+
+class CPSamplingPlan:
+    """
+    Per feature resolution, everything pano CPAttn derives from the geometry, for all views at once: the
+    samples of the 3x3 kernel around the correspondence of each query pixel in each of the n neighbors.
+        neighbor_index: (m, n) neighbor view indices
+        grids:          (b, m, n*9, h, w, 2) normalized grid_sample positions, neighbor-major
+        xy_rel:         (b, m, n*9, h, w, 2) relative positions of the samples, input of the PE
+        masks:          (b, m, n*9, h, w) samples inside the neighbor image
+    With a plan, a CPAttn step only gathers features and runs attention. The positional encodings are geometry
+    too: they are cached with the plan per PosEmbedding.key, the CPAttns of a level share them.
+    """
+
+    def __init__(self, neighbor_index, grids, xy_rel, masks, h, w):
+        self.neighbor_index = neighbor_index
+        self.grids = grids
+        self.xy_rel = xy_rel
+        self.masks = masks
+        self.h = h
+        self.w = w
+        self._pe = {}
+
+    def positional_encodings(self, pe):
+        """
+        (key_pe, mask, query_pe) of PosEmbedding pe, computed once per plan:
+            key_pe:   ((b m h w), n*9, c) embedding of xy_rel, zero for the masked samples
+            mask:     ((b m h w), n*9, 1) masks as a float multiplier
+            query_pe: (1, 1, c) embedding of the query position (0, 0), the same for every query pixel
+        """
+        encodings = self._pe.get(pe.key)
+        if encodings is None:
+            xy_rel = rearrange(self.xy_rel, 'b m l h w c -> (b m h w) l c')
+            mask = rearrange(self.masks, 'b m l h w -> (b m h w) l')[..., None]
+            key_pe = pe(xy_rel)*mask
+            query_pe = pe(torch.zeros(1, 1, 2, device=xy_rel.device))
+            encodings = self._pe[pe.key] = (key_pe, mask.to(key_pe.dtype), query_pe)
+        return encodings
+
+    def sample(self, x, groups=1):
+        """
+        Gather the kernel samples of every view from its neighbors' features x ((g b) m c h w) -> ((g b) m n*9 c h w).
+        The `groups` batch groups share the plan's geometry, they are sampled as extra channels.
+        """
+        b, m, n = self.grids.shape[0], *self.neighbor_index.shape
+        x = rearrange(x, '(g b) m c h w -> b m (g c) h w', g=groups)
+        x_right = rearrange(x[:, self.neighbor_index], 'b m n c h w -> (b m n) c h w')
+        grids = rearrange(self.grids, 'b m (n k) h w c -> (b m n) k h w c', n=n)
+        key_value = sample_key_value(x_right, grids)
+        return rearrange(key_value, '(b m n) k (g c) h w -> (g b) m (n k) c h w', b=b, m=m, g=groups)
+
+
+def build_sampling_plan(correspondences, h, w):
+    """CPSamplingPlan of an (h, w) feature level, from the NeighborCorrespondences of a rig."""
+    # query and key maps are the same level, the key scale is the row scale
+    img_h, img_w = correspondences.img_h, correspondences.img_w
+    scale = img_h//h
+    xy_l = correspondences.xy_at(scale).float()
+    b, m, n = xy_l.shape[:3]
+
+    # all (view, neighbor) pairs as one batch
+    grids, xy_rel, mask = kernel_geometry(rearrange(xy_l, 'b m n h w c -> (b m n) h w c'),
+                                          correspondences.homo_r.reshape(-1, 3, 3), img_h, img_w, scale, scale, h, w)
+    grids = rearrange(grids, '(b m n) k h w c -> b m (n k) h w c', b=b, m=m)
+    xy_rel = rearrange(xy_rel, '(b m n) k h w c -> b m (n k) h w c', b=b, m=m)
+    mask = rearrange(mask, '(b m n) k h w -> b m (n k) h w', b=b, m=m)
+    return CPSamplingPlan(correspondences.neighbor_index, grids, xy_rel, mask, h, w)
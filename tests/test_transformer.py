@@ -0,0 +1,53 @@
+import pytest
+import torch
+from src.models.modules.transformer import CrossAttention
+
+
+def cross_attention(dim, heads, dim_head):
+    torch.manual_seed(0)
+    attn = CrossAttention(dim, context_dim=dim, heads=heads, dim_head=dim_head)
+    with torch.no_grad():
+        for param in attn.parameters():
+            param.normal_(0, dim ** -0.5)
+    return attn.eval()
+
+
+@pytest.mark.parametrize('masked', [False, True])
+@pytest.mark.parametrize('scale', [None, 0.1])
+def test_single_query_attention_matches_einsum(masked, scale):
+    attn = cross_attention(64, 2, 32)
+    if scale is not None:
+        attn.scale = scale
+    x = torch.randn(50, 1, 64)
+    context = torch.randn(50, 11, 64)
+    mask = None
+    if masked:
+        # at least one valid entry per row, like padded neighbor sets
+        mask = torch.arange(11)[None] < torch.randint(1, 12, (50, 1))
+
+    with torch.no_grad():
+        attn.fused = False
+        ref = attn(x, context, mask)
+        attn.fused = True
+        out = attn(x, context, mask)
+    assert torch.allclose(out, ref, atol=1e-5, rtol=1e-4)
+
+
+def test_single_query_attention_fully_masked_rows():
+    # padded depth neighbors can leave a row without any valid key
+    attn = cross_attention(64, 2, 32)
+    x = torch.randn(4, 1, 64)
+    context = torch.randn(4, 5, 64)
+    mask = torch.tensor([[True, True, False, False, False], [False] * 5, [True] * 5, [False] * 5])
+
+    with torch.no_grad():
+        attn.fused = False
+        ref = attn(x, context, mask)
+        attn.fused = True
+        out = attn(x, context, mask)
+    assert torch.isfinite(out).all()
+    assert torch.allclose(out, ref, atol=1e-5, rtol=1e-4)
+
+
+def test_cross_attention_fused_off_by_default():
+    assert not CrossAttention.fused